@@ -0,0 +1,304 @@
+"""
+Time and peak memory of every stage of the app on synthetic rides (see synthetic.py).
+
+    python benchmarks/bench.py                     # run and compare with baselines.json
+    python benchmarks/bench.py --save              # run and store the results as the new baselines
+    python benchmarks/bench.py -k figure --hours 1 # only the benchmarks with 'figure' in their name
+
+The time of a benchmark is the best of --repeat runs, the peak memory is measured in one more run
+under tracemalloc (numpy and pandas report their buffers to it). A benchmark fails the check when its
+time or its peak memory grows more than --threshold over the baseline; baselines are only comparable
+on the machine and scenario (riders, hours...) they were measured with, the scenario is stored with them.
+"""
+import argparse
+import base64
+import gc
+import gzip
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+sys.path.insert(0, HERE)
+
+import synthetic  # noqa: E402
+import aux  # noqa: E402
+import callbacks  # noqa: E402
+from catalog import RideCatalog  # noqa: E402
+from components.memory import MemoryRides  # noqa: E402
+from features import RideFeatures  # noqa: E402
+from figures import build_leader_figure, build_speed_figure, build_kilojoules_figure, \
+    build_power_curve_figure  # noqa: E402
+from fit_decoder import compare_engines  # noqa: E402
+from power import matrix_w_prime_balance, TABLE_DURATIONS  # noqa: E402
+from windows import trailing_windows  # noqa: E402
+
+BASELINES = os.path.join(HERE, 'baselines.json')
+
+# Changes below these are noise whatever the threshold, e.g. on the figures of a few milliseconds
+NOISE = {'seconds': 0.005, 'peak_mb': 1.0}
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Register a benchmark: a function taking the Scenario and returning the function to time
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+class Scenario:
+    """
+    Synthetic rides written to fit.gz files and everything the benchmarks start from
+    """
+
+    def __init__(self, directory, riders, hours, interval, dropout, gaps, seed):
+        self.parameters = {'riders': riders, 'hours': hours, 'interval': interval, 'dropout': dropout,
+                           'gaps': gaps, 'seed': seed}
+        self.paths = synthetic.write_rides(os.path.join(directory, 'rides'), riders, int(hours * 3600), interval,
+                                           dropout, gaps, seed=seed)
+        self.names = [os.path.basename(path) for path in self.paths]
+        self.contents = []
+        self.raw = []
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.contents.append('data:application/gzip;base64,' + base64.b64encode(data).decode())
+            self.raw.append(gzip.decompress(data))
+
+        self.records = [aux.read_records_fit(raw)[:2] for raw in self.raw]
+        self.rides, _ = aux.load_rides(self.contents, self.names, max_workers=1)
+        self.leader = next(iter(self.rides))
+        self.riders_data = {name: {'weight': 70, 'ftp': 250} for name in self.rides}
+
+        # The start time correction goes through the session store, as in the app
+        callbacks.rides_memory = MemoryRides(directory=os.path.join(directory, 'sessions'))
+        self.rides_key = '00000000-0000-4000-8000-000000000000'
+        callbacks.rides_memory.set_rides(self.rides_key, self.rides)
+        start = pd.Timestamp(min(df['timestamp'].iloc[0] for df in self.rides.values()) + 300, unit='s', tz='UTC')
+        self.start_time = (start.hour, start.minute, start.second)
+        callbacks.correct_rides(*self.start_time, self.rides_key)
+        self.corrected_rides = callbacks.rides_memory.get_corrected_rides(self.rides_key)
+
+        self.features = RideFeatures(self.corrected_rides)
+        self.power_curve = (self.features.power_durations, self.features.power_curves)
+
+
+@benchmark('decode')
+def bench_decode(scenario):
+    return lambda: [aux.read_records_fit(raw, engine='fast') for raw in scenario.raw]
+
+
+@benchmark('decode_sdk')
+def bench_decode_sdk(scenario):
+    return lambda: [aux.read_records_fit(raw, engine='sdk') for raw in scenario.raw]
+
+
+@benchmark('build_df')
+def bench_build_df(scenario):
+    return lambda: [aux.build_df(records, events) for records, events in scenario.records]
+
+
+@benchmark('upload')
+def bench_upload(scenario):
+    return lambda: aux.load_rides(scenario.contents, scenario.names)
+
+
+@benchmark('start_time_correction')
+def bench_correction(scenario):
+    return lambda: callbacks.correct_rides(*scenario.start_time, scenario.rides_key)
+
+
+@benchmark('trailing_windows')
+def bench_trailing_windows(scenario):
+    return lambda: trailing_windows(scenario.corrected_rides)
+
+
+@benchmark('features')
+def bench_features(scenario):
+    return lambda: RideFeatures(scenario.corrected_rides)
+
+
+@benchmark('metrics')
+def bench_metrics(scenario):
+    return lambda: aux.build_metrics(scenario.features.rides, scenario.riders_data, scenario.power_curve)
+
+
+@benchmark('w_balance')
+def bench_w_balance(scenario):
+    return lambda: matrix_w_prime_balance(scenario.features.matrix, scenario.riders_data)
+
+
+@benchmark('gap_table')
+def bench_gap_table(scenario):
+    return lambda: callbacks.update_gap_table(scenario.features, scenario.leader)
+
+
+@benchmark('leader_figure')
+def bench_leader_figure(scenario):
+    return lambda: build_leader_figure(scenario.features, scenario.leader)
+
+
+@benchmark('speed_figure')
+def bench_speed_figure(scenario):
+    return lambda: build_speed_figure(scenario.features)
+
+
+@benchmark('kilojoules_figure')
+def bench_kilojoules_figure(scenario):
+    return lambda: build_kilojoules_figure(scenario.features)
+
+
+@benchmark('power_curve_figure')
+def bench_power_curve_figure(scenario):
+    return lambda: build_power_curve_figure(scenario.features)
+
+
+def measure(function, repeat):
+    """
+    :return: best and median seconds of repeat runs and the peak traced memory of one more run in MB
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'median_seconds': statistics.median(times), 'peak_mb': peak / 2 ** 20}
+
+
+def check(results, baselines, threshold):
+    """
+    :return: the regressions as messages, an empty list when every benchmark is within the threshold
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        for metric in ('seconds', 'peak_mb'):
+            growth = result[metric] - baseline[metric]
+            if growth > baseline[metric] * threshold and growth > NOISE[metric]:
+                regressions.append(f'{name}: {metric} {result[metric]:.4g} > baseline {baseline[metric]:.4g} '
+                                   f'+{threshold:.0%}')
+    return regressions
+
+
+def check_parity(scenario):
+    """
+    The fast decoder must give the same records as garmin_fit_sdk on the synthetic files
+    """
+    failed = []
+    for name, raw in zip(scenario.names, scenario.raw):
+        report = compare_engines(raw)
+        if not all(value <= 1e-6 for value in report.values()):
+            failed.append(f'{name}: {report}')
+    return failed
+
+
+def check_power_columns(directory):
+    """
+    The best power columns of the comparative table and the best powers of the catalog must have a value for
+    rides with dropped samples and for 2 s recordings, as long as the rides are longer than the column
+    """
+    failed = []
+    catalog = RideCatalog(os.path.join(directory, 'catalog.sqlite'))
+    for interval, dropout, gaps in [(1, 0.01, 2), (2, 0.0, 0)]:
+        name = f'{interval} s samples, {dropout:.0%} dropout, {gaps} gaps'
+        ride = aux.build_ride(synthetic.make_ride(duration=3900, interval=interval, dropout=dropout, gaps=gaps))
+        table = aux.build_metrics({name: ride}, {name: {'weight': 70, 'ftp': 250}})
+        columns = [column for column in table.columns if column.startswith(('Best', 'CS'))]
+        missing = [column.strip() for column in columns if not np.isfinite(table[column].iloc[0])]
+
+        catalog.add_rides({name: ride})
+        missing += [f'catalog best {duration} s' for duration in TABLE_DURATIONS
+                    if name not in set(catalog.best_power(duration)['rider'])]
+        if missing:
+            failed.append(f'{name}: no {", ".join(missing)}')
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='keyword', default='', help='only the benchmarks with this in their name')
+    parser.add_argument('--riders', type=int, default=6)
+    parser.add_argument('--hours', type=float, default=6)
+    parser.add_argument('--interval', type=int, default=1, help='seconds between samples')
+    parser.add_argument('--dropout', type=float, default=0.01, help='fraction of samples lost')
+    parser.add_argument('--gaps', type=int, default=2, help='one minute holes in every ride')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed growth over the baseline')
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baselines')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        scenario = Scenario(directory, args.riders, args.hours, args.interval, args.dropout, args.gaps, args.seed)
+
+        parity_errors = check_parity(scenario)
+        print('engine parity', 'FAIL' if parity_errors else 'OK')
+        for error in parity_errors:
+            print('  ' + error)
+        power_errors = check_power_columns(directory)
+        print('power columns', 'FAIL' if power_errors else 'OK')
+        for error in power_errors:
+            print('  ' + error)
+
+        report = aux.ride_memory_report(scenario.rides)
+        print(report[['name', 'rows', 'bytes', 'bytes per row']].to_string(index=False))
+
+        results = {}
+        for name, setup in BENCHMARKS.items():
+            if args.keyword not in name:
+                continue
+            results[name] = measure(setup(scenario), args.repeat)
+            print(f"{name:<24}{results[name]['seconds']:>10.4f} s{results[name]['peak_mb']:>10.1f} MB")
+
+    stored = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            stored = json.load(f)
+
+    if args.save:
+        benchmarks = dict(stored.get('benchmarks', {})) if stored.get('scenario') == scenario.parameters else {}
+        benchmarks.update(results)
+        with open(args.baselines, 'w') as f:
+            json.dump({'scenario': scenario.parameters, 'machine': platform.platform(),
+                       'python': platform.python_version(), 'benchmarks': benchmarks}, f, indent=2)
+            f.write('\n')
+        print(f'baselines saved to {args.baselines}')
+        return 1 if parity_errors or power_errors else 0
+
+    if stored.get('scenario') != scenario.parameters:
+        print('no baselines for this scenario, run with --save to store them')
+        return 1 if parity_errors or power_errors else 0
+
+    regressions = check(results, stored['benchmarks'], args.threshold)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions or parity_errors or power_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
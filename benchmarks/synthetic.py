@@ -0,0 +1,166 @@
+"""
+Deterministic synthetic rides written as real fit.gz files, the same seed always gives the same bytes.
+
+    python benchmarks/synthetic.py output_directory --riders 10 --hours 6
+"""
+import argparse
+import gzip
+import os
+import struct
+
+import numpy as np
+
+FIT_EPOCH_S = 631065600
+SEMICIRCLES_PER_DEGREE = 2 ** 31 / 180
+
+# (field number, field name, numpy type, FIT base type) of the record messages
+RECORD_FIELDS = [
+    (253, 'timestamp', '<u4', 0x86),
+    (0, 'position_lat', '<i4', 0x85),
+    (1, 'position_long', '<i4', 0x85),
+    (5, 'distance', '<u4', 0x86),
+    (73, 'enhanced_speed', '<u4', 0x86),
+    (2, 'altitude', '<u2', 0x84),
+    (78, 'enhanced_altitude', '<u4', 0x86),
+    (3, 'heart_rate', 'u1', 0x02),
+    (4, 'cadence', 'u1', 0x02),
+    (7, 'power', '<u2', 0x84),
+]
+INVALID = {'<u2': 0xFFFF, 'u1': 0xFF}
+
+
+def crc16(data):
+    table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+    # One lookup per byte instead of two per nibble
+    byte_table = []
+    for byte in range(256):
+        crc = 0
+        for nibble in (byte & 0xF, byte >> 4):
+            tmp = table[crc & 0xF]
+            crc = (crc >> 4) & 0x0FFF
+            crc = crc ^ tmp ^ table[nibble]
+        byte_table.append(crc)
+
+    crc = 0
+    for byte in data:
+        crc = (crc >> 8) ^ byte_table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def definition_message(local, global_number, fields):
+    message = struct.pack('<BBBHB', 0x40 | local, 0, 0, global_number, len(fields))
+    for number, size, base_type in fields:
+        message += struct.pack('<BBB', number, size, base_type)
+    return message
+
+
+def event_message(local, timestamp, event_type):
+    # timer event, start (0) or stop all (4)
+    return struct.pack('<BIBB', local, timestamp - FIT_EPOCH_S, 0, event_type)
+
+
+def ride_samples(duration, start, interval=1, dropout=0.0, gaps=0, power=True, seed=0):
+    """
+    Samples of a rolling ride: speed and power waves, a few climbs and random noise.
+    :param interval: seconds between samples
+    :param dropout: fraction of single samples lost
+    :param gaps: number of one minute holes in the recording, as in a tunnel
+    :return: {field name: values} in FIT units, invalid values where a field is missing
+    """
+    rng = np.random.default_rng(seed)
+    seconds = np.arange(0, duration, interval)
+    n = len(seconds)
+
+    altitude = 200 + 150 * np.sin(seconds / 1500 + seed) + 30 * np.sin(seconds / 170)
+    slope = np.gradient(altitude, seconds) if n > 1 else np.zeros(n)
+    speed = np.clip(10 - 60 * slope + 2 * np.sin(seconds / 97) + rng.normal(0, 0.4, n), 2, 25)
+    distance = np.cumsum(speed * interval)
+    heading = np.cumsum(rng.normal(0, 0.01, n))
+    latitude = 43 + np.cumsum(speed * interval * np.cos(heading)) / 111000
+    longitude = 1 + np.cumsum(speed * interval * np.sin(heading)) / 81000
+    ftp = 230 + 10 * (seed % 8)
+    watts = np.clip(ftp * (0.8 + 5 * slope) + 120 * np.sin(seconds / 13) + rng.normal(0, 40, n), 0, 1500)
+    coasting = rng.random(n) < 0.05
+
+    samples = {
+        'timestamp': start - FIT_EPOCH_S + seconds,
+        'position_lat': np.round(latitude * SEMICIRCLES_PER_DEGREE),
+        'position_long': np.round(longitude * SEMICIRCLES_PER_DEGREE),
+        'distance': np.round(distance * 100),
+        'enhanced_speed': np.round(speed * 1000),
+        'altitude': np.round((altitude + 500) * 5),
+        'enhanced_altitude': np.round((altitude + 500) * 5),
+        'heart_rate': np.clip(np.round(110 + watts / 6 + rng.normal(0, 2, n)), 60, 200),
+        'cadence': np.where(coasting, 0, np.clip(np.round(88 + rng.normal(0, 4, n)), 0, 130)),
+        'power': np.where(coasting, 0, np.round(watts)),
+    }
+    if not power:
+        samples['power'] = np.full(n, INVALID['<u2'])
+
+    kept = rng.random(n) >= dropout
+    for start_gap in rng.integers(0, max(n - 60 // interval, 1), gaps):
+        kept[start_gap:start_gap + 60 // interval] = False
+    kept[0] = True
+    return {name: values[kept] for name, values in samples.items()}
+
+
+def make_ride(duration=3600, start=1700000000, interval=1, dropout=0.0, gaps=0, power=True, seed=0):
+    """
+    :return: the bytes of a FIT activity file with a timer start, the records and a timer stop
+    """
+    samples = ride_samples(duration, start, interval, dropout, gaps, power, seed)
+
+    dtype = np.dtype([('header', 'u1')] + [(name, numpy_type) for _, name, numpy_type, _ in RECORD_FIELDS])
+    records = np.zeros(len(samples['timestamp']), dtype=dtype)
+    records['header'] = 2
+    for _, name, _, _ in RECORD_FIELDS:
+        records[name] = samples[name]
+
+    body = definition_message(0, 0, [(0, 1, 0x00), (1, 2, 0x84), (4, 4, 0x86)])
+    body += struct.pack('<BBHI', 0, 4, 1, start - FIT_EPOCH_S)  # file_id: activity, garmin
+    body += definition_message(1, 21, [(253, 4, 0x86), (0, 1, 0x00), (1, 1, 0x00)])
+    body += event_message(1, start, 0)
+    body += definition_message(2, 20, [(number, np.dtype(numpy_type).itemsize, base_type)
+                                       for number, _, numpy_type, base_type in RECORD_FIELDS])
+    body += records.tobytes()
+    body += event_message(1, start + duration, 4)
+
+    header = struct.pack('<BBHI4s', 14, 0x20, 2133, len(body), b'.FIT')
+    header += struct.pack('<H', crc16(header))
+    data = header + body
+    return data + struct.pack('<H', crc16(data))
+
+
+def write_rides(directory, riders=4, duration=3600, interval=1, dropout=0.0, gaps=0, power=True, seed=0):
+    """
+    One fit.gz file per rider, every rider starts a few seconds after the previous one
+    :return: the paths of the files
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for rider in range(riders):
+        data = make_ride(duration, 1700000000 + 7 * rider, interval, dropout, gaps, power, seed + rider)
+        path = os.path.join(directory, f'rider{rider}.fit.gz')
+        with open(path, 'wb') as f:
+            # mtime=0 keeps the gzip bytes deterministic
+            f.write(gzip.compress(data, mtime=0))
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic fit.gz rides')
+    parser.add_argument('directory')
+    parser.add_argument('--riders', type=int, default=4)
+    parser.add_argument('--hours', type=float, default=1)
+    parser.add_argument('--interval', type=int, default=1, help='seconds between samples')
+    parser.add_argument('--dropout', type=float, default=0.0, help='fraction of samples lost')
+    parser.add_argument('--gaps', type=int, default=0, help='one minute holes in the recording')
+    parser.add_argument('--no-power', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for path in write_rides(args.directory, args.riders, int(args.hours * 3600), args.interval, args.dropout,
+                            args.gaps, not args.no_power, args.seed):
+        print(path)
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+# Columns that change smoothly and are interpolated over the gaps of a ride
+INTERPOLATED_COLUMNS = ('distance', 'altitude', 'position_lat', 'position_long')
+# Longest time between rides put on the same grid, seconds: rides further apart are not of the same event,
+# and every second between them would be allocated for every rider
+MAX_GRID_GAP = 3600
+
+
+class RidesDoNotOverlap(ValueError):
+    pass
+
+
+class RideMatrix:
+    """
+    Rides of several riders resampled on one shared 1 Hz grid of epoch seconds.
+    Every column is a contiguous (riders, seconds) float array, NaN before the start and after the end of a ride.
+    mask tells which values were recorded; inside a ride the gaps of the INTERPOLATED_COLUMNS are filled
+    by linear interpolation and the rest stay NaN.
+    """
+
+    def __init__(self, riders, time, columns, mask):
+        self.riders = riders
+        self.time = time
+        self.columns = columns
+        self.mask = mask
+        self.index = {rider: i for i, rider in enumerate(riders)}
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def row(self, column, rider):
+        return self.columns[column][self.index[rider]]
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+
+def epoch_seconds(timestamps):
+    # The ride DataFrames already store the timestamps as epoch seconds
+    if pd.api.types.is_integer_dtype(timestamps):
+        return np.asarray(timestamps, dtype=np.int64)
+    return (pd.to_datetime(timestamps).astype('int64') // 10 ** 9).to_numpy()
+
+
+def ride_groups(spans, max_gap=MAX_GRID_GAP):
+    """
+    Rides that overlap, or that are at most max_gap seconds apart, directly or through other rides
+    :param spans: {name: (first epoch second, last epoch second)}
+    :return: the groups as lists of names, the group with the most rides first
+    """
+    groups = []
+    end = None
+    for name, (first, last) in sorted(spans.items(), key=lambda item: item[1]):
+        if end is None or first - end > max_gap:
+            groups.append([])
+            end = last
+        groups[-1].append(name)
+        end = max(end, last)
+    return sorted(groups, key=len, reverse=True)
+
+
+def build_ride_matrix(rides, columns=('distance', 'altitude', 'speed', 'power', 'heart_rate')):
+    """
+    :raise RidesDoNotOverlap: when the rides are more than MAX_GRID_GAP apart, before allocating the grid
+    """
+    riders = list(rides.keys())
+    times = [epoch_seconds(df['timestamp']) for df in rides.values()]
+
+    groups = ride_groups({name: (t.min(), t.max()) for name, t in zip(riders, times) if len(t)})
+    if len(groups) > 1:
+        raise RidesDoNotOverlap(f'Rides more than {MAX_GRID_GAP // 60} minutes apart: '
+                                + ' / '.join(', '.join(group) for group in groups))
+
+    if not riders or not any(len(t) for t in times):
+        time = np.empty(0, dtype=np.int64)
+    else:
+        time = np.arange(min(t.min() for t in times if len(t)), max(t.max() for t in times if len(t)) + 1)
+
+    shape = (len(riders), len(time))
+    mask = np.zeros(shape, dtype=bool)
+    matrix = {column: np.full(shape, np.nan) for column in columns}
+
+    for i, (df, t) in enumerate(zip(rides.values(), times)):
+        if len(t) == 0:
+            continue
+        # Several samples in the same second keep the last one
+        seconds = t - time[0]
+        last = np.r_[seconds[1:] != seconds[:-1], True]
+        seconds = seconds[last]
+        mask[i, seconds] = True
+
+        inside = slice(seconds[0], seconds[-1] + 1)
+        for column in columns:
+            if column not in df.columns:
+                continue
+            values = df[column].to_numpy(dtype=float)[last]
+            if column in INTERPOLATED_COLUMNS:
+                recorded = ~np.isnan(values)
+                if recorded.any():
+                    matrix[column][i, inside] = np.interp(np.arange(seconds[0], seconds[-1] + 1),
+                                                          seconds[recorded], values[recorded])
+            else:
+                matrix[column][i, seconds] = values
+
+    return RideMatrix(riders, time, matrix, mask)
+
+
+def passing_times(matrix, marks):
+    """
+    Time at which every rider first reached each distance mark, interpolated between the two seconds around it.
+    All the riders are searched at once: every row is made non decreasing and shifted above the previous one,
+    so the flattened matrix is sorted and a single searchsorted finds the marks of every rider.
+    :return: (riders, marks) array of epoch seconds, NaN for the marks a rider did not reach
+    """
+    marks = np.asarray(marks, dtype=float)
+    n_riders, n_seconds = matrix.shape
+    if n_seconds == 0 or len(marks) == 0:
+        return np.full((n_riders, len(marks)), np.nan)
+
+    # Before the start of a ride the distance stays NaN
+    distance = np.fmax.accumulate(matrix['distance'], axis=1)
+    distance = np.where(np.isnan(distance), -1.0, distance)
+
+    shift = (max(distance.max(), marks.max()) + 2) * np.arange(n_riders)[:, None]
+    flat = (distance + shift).ravel()
+    index = np.searchsorted(flat, (marks[None, :] + shift).ravel()).reshape(n_riders, len(marks))
+    index -= np.arange(n_riders)[:, None] * n_seconds
+
+    reached = index < n_seconds
+    rows = np.arange(n_riders)[:, None]
+    after = np.minimum(index, n_seconds - 1)
+    before = np.maximum(after - 1, 0)
+    distance_before = distance[rows, before]
+    distance_after = distance[rows, after]
+
+    step = distance_after - distance_before
+    fraction = np.where((after > 0) & (distance_before >= 0) & (step > 0),
+                        (marks[None, :] - distance_before) / np.where(step > 0, step, 1), 1.0)
+    times = matrix.time[before] + fraction * (matrix.time[after] - matrix.time[before])
+    times = np.where(after == before, matrix.time[after], times)
+
+    return np.where(reached, times, np.nan)
+
+
+def time_gaps(matrix, leader, step=1000):
+    """
+    Time gap of every rider to the leader at every step metres of the leader's ride
+    :return: the marks in metres and a (riders, marks) array of seconds, positive when behind the leader
+    """
+    max_distance = np.nanmax(matrix.row('distance', leader), initial=0)
+    marks = np.arange(step, max_distance + 1, step)
+
+    times = passing_times(matrix, marks)
+    return marks, times - times[matrix.index[leader]]
+
+
+def distance_gaps(matrix, leader):
+    """
+    :return: (riders, seconds) array of metres to the leader at every second, negative when behind
+    """
+    return matrix['distance'] - matrix.row('distance', leader)
@@ -1,16 +1,37 @@
-from dash import Dash, html, dcc
+import logging
+
+from dash import Dash, html, dcc, DiskcacheManager
 import dash_bootstrap_components as dbc
+import diskcache
 from layout import create_layout
 import callbacks  # This imports and registers all callbacks
 from components.memory import create_memory, MemoryRides
+from storage import default_directory
+from uploads import register_upload_route
+from export import register_export_route
+from instrumentation import register_instrumentation
+from startup import boot
+
+# The caches report their hit rates and timings at INFO, the background jobs inherit it
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(name)s %(levelname)s: %(message)s')
 
-app = Dash(__name__, external_stylesheets=[dbc.themes.FLATLY])
+# Upload and Process run as background jobs, their state is shared by all the workers through this cache
+background_callback_manager = DiskcacheManager(diskcache.Cache(default_directory('background-jobs')))
+
+app = Dash(__name__, external_stylesheets=[dbc.themes.FLATLY],
+           background_callback_manager=background_callback_manager)
 server = app.server
+register_upload_route(server)
+register_export_route(server)
+register_instrumentation(server)
 
 app.layout = html.Div([
     create_layout(),
     create_memory()])
 
+# Warm-up and timings, with gunicorn --preload once in the master for all the workers
+boot(server)
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+// Follow the leader figure drawn in the browser when the leader changes. The Process results include the
+// distance and altitude of every rider (figures.build_leader_data) as base64 float32 arrays, so a new
+// leader is only a subtraction here instead of a server request sending all the traces again.
+(function () {
+    var decoded = {data: null, arrays: null};
+
+    function decodeArray(text) {
+        var binary = atob(text);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new Float32Array(bytes.buffer);
+    }
+
+    function arrays(data) {
+        // The arrays are decoded once for every new Process result
+        if (decoded.data !== data) {
+            var result = {distance: {}, altitude: {}};
+            data.riders.forEach(function (rider) {
+                result.distance[rider] = decodeArray(data.distance[rider]);
+                result.altitude[rider] = decodeArray(data.altitude[rider]);
+            });
+            decoded = {data: data, arrays: result};
+        }
+        return decoded.arrays;
+    }
+
+    function leaderFigure(leader, data, currentLeader) {
+        var noUpdate = window.dash_clientside.no_update;
+        if (!leader || !data || leader === currentLeader || data.riders.indexOf(leader) < 0) {
+            return [noUpdate, noUpdate, noUpdate];
+        }
+
+        var values = arrays(data);
+        var reference = values.distance[leader];
+        var kilometres = new Float32Array(reference.length);
+        for (var i = 0; i < reference.length; i++) {
+            kilometres[i] = reference[i] / 1000;
+        }
+
+        // Same traces and layout as figures.build_leader_figure
+        var traces = [{
+            x: kilometres, y: values.altitude[leader], mode: 'lines', name: 'altitude', type: 'scatter',
+            xaxis: 'x', yaxis: 'y2'
+        }];
+        data.riders.forEach(function (rider) {
+            if (rider === leader) {
+                return;
+            }
+            var distance = values.distance[rider];
+            var differences = new Float32Array(reference.length);
+            for (var i = 0; i < reference.length; i++) {
+                differences[i] = distance[i] - reference[i];
+            }
+            traces.push({x: kilometres, y: differences, mode: 'lines', name: rider, type: 'scatter',
+                         xaxis: 'x', yaxis: 'y'});
+        });
+
+        var figure = {
+            data: traces,
+            layout: {
+                title: {text: '<b>Distance with respect to the Leader ' + leader + '</b>'},
+                uirevision: leader,
+                xaxis: {anchor: 'y', domain: [0.0, 0.94], title: {text: 'Distance (Km)'}},
+                yaxis: {anchor: 'x', domain: [0.0, 1.0], title: {text: 'Difference (meters)'}},
+                yaxis2: {anchor: 'x', overlaying: 'y', side: 'right', title: {text: 'Altitude (meters)'}}
+            }
+        };
+        return [figure, {display: 'flex'}, leader];
+    }
+
+    window.dash_clientside = window.dash_clientside || {};
+    window.dash_clientside.cycling = Object.assign({}, window.dash_clientside.cycling, {leaderFigure: leaderFigure});
+})();
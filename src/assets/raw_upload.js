@@ -0,0 +1,82 @@
+// Send the race files to the raw upload route (uploads.py) instead of letting dcc.Upload put them
+// base64 encoded inside the callback JSON. The files go as a multipart request and only the upload key
+// is handed to the Dash layout, the memory-upload-key store triggers the decoding on the server.
+(function () {
+    var UPLOAD_ID = 'upload-fit-data';
+    var UPLOAD_ROUTE = 'upload/fit';
+
+    function setProps(id, props) {
+        if (window.dash_clientside && window.dash_clientside.set_props) {
+            window.dash_clientside.set_props(id, props);
+        }
+    }
+
+    function uploadUrl() {
+        // Relative to the Dash requests prefix, so it works behind a path prefix too
+        var config = document.getElementById('_dash-config');
+        var prefix = config ? (JSON.parse(config.textContent).requests_pathname_prefix || '/') : '/';
+        return prefix + UPLOAD_ROUTE;
+    }
+
+    function sendFiles(files) {
+        if (!files || !files.length) {
+            return;
+        }
+        var form = new FormData();
+        for (var i = 0; i < files.length; i++) {
+            form.append('files', files[i], files[i].name);
+        }
+
+        var request = new XMLHttpRequest();
+        request.open('POST', uploadUrl());
+        request.upload.onprogress = function (event) {
+            if (event.lengthComputable) {
+                setProps('upload-progress', {value: event.loaded, max: event.total, style: {width: '100%'}});
+            }
+        };
+        request.onload = function () {
+            setProps('upload-progress', {style: {display: 'none'}});
+            var response = {};
+            try {
+                response = JSON.parse(request.responseText);
+            } catch (e) {
+                response = {error: request.statusText || 'Upload failed'};
+            }
+            if (request.status === 200 && response.upload_key) {
+                setProps('memory-upload-key', {data: response.upload_key});
+            } else {
+                setProps('upload-status', {children: 'Upload failed: ' + (response.error || request.status)});
+            }
+        };
+        request.onerror = function () {
+            setProps('upload-progress', {style: {display: 'none'}});
+            setProps('upload-status', {children: 'Upload failed, please try again'});
+        };
+        request.send(form);
+    }
+
+    function insideUpload(target) {
+        return target && target.closest && target.closest('#' + UPLOAD_ID);
+    }
+
+    // Capture phase, so the files are taken before dcc.Upload reads them
+    document.addEventListener('change', function (event) {
+        var input = event.target;
+        if (!insideUpload(input) || input.type !== 'file') {
+            return;
+        }
+        event.stopImmediatePropagation();
+        sendFiles(input.files);
+        // Selecting the same files again fires a new change
+        input.value = '';
+    }, true);
+
+    document.addEventListener('drop', function (event) {
+        if (!insideUpload(event.target) || !event.dataTransfer) {
+            return;
+        }
+        event.preventDefault();
+        event.stopImmediatePropagation();
+        sendFiles(event.dataTransfer.files);
+    }, true);
+})();
@@ -1,197 +1,430 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import timedelta
 
+import numpy as np
 import pandas as pd
 from dash import  html,  dash_table
 import base64
 import gzip
-from garmin_fit_sdk import Stream, Decoder
+import zlib
 
-N_DECIMALS = 3
+from config import config
+from fit_decoder import read_records
+from instrumentation import timed, call_with_spans, record_spans
+from alignment import epoch_seconds, ride_groups, MAX_GRID_GAP
+from power import power_curves, TABLE_DURATIONS, W_BALANCE_THRESHOLDS
+from storage import content_key, path_key, slice_frame
+from summary import summarize_rides
 
+logger = logging.getLogger(__name__)
 
-def parse_content(content):
-    print("JF--> parse_content")
-    data = None
 
+def decompress_content(content):
     content_type, content_string = content.split(',')
 
     decoded = base64.b64decode(content_string)
 
-    fit_raw_data = gzip.decompress(decoded)
+    return gzip.decompress(decoded)
+
+
+def decompress_file(path, chunk_size=2 ** 20):
+    """
+    Gunzip a fit.gz file from disk a chunk at a time, the compressed file is never fully in memory
+    :return: the FIT bytes, as a bytearray
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    fit_raw_data = bytearray()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            fit_raw_data += decompressor.decompress(chunk)
+            # Concatenated gzip members, as gzip.decompress accepts them
+            while decompressor.eof and decompressor.unused_data:
+                unused_data = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+                fit_raw_data += decompressor.decompress(unused_data)
+    fit_raw_data += decompressor.flush()
+    if not decompressor.eof:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    # The decoders read a bytearray as well as bytes, a copy would double the peak memory
+    return fit_raw_data
+
+
+def decode_fit(fit_raw_data):
+    # The fast engine only needs the SDK for the files it cannot read
+    from garmin_fit_sdk import Stream, Decoder
 
     stream = Stream.from_byte_array(fit_raw_data)  # Stream.from_byte_array(io.BytesIO(decoded))
     decoder = Decoder(stream)
     messages, errors = decoder.read()
 
-    if len(messages['record_mesgs']) > 3:
-        data = {
-            'ride': messages['record_mesgs'],
-            'events': messages['event_mesgs']
-        }
-
-    print("JF<-- parse_content")
-    return data
-
-
-def add_best_power_values(df, period_list):
-    # period_list in seconds, e.g, [30, 60, 600, 1200, 3600] for best 30", 1', 10', 20', 60'
-    # Calculate the rolling sum over the last 3600 seconds (1 hour), assuming the data is in 1-second intervals
-    for period in period_list:
-        df[f'Best {period}"'] = df['power'].rolling(period).mean()
-
-    return df
-
-
-def compute_avg_NP(df):
-    df_tmp = df.copy()
-    df_tmp['rolling_average'] = df_tmp['power'].rolling(30).mean()
-    df_tmp.dropna(subset=["rolling_average"], inplace=True)
-    df_tmp.reset_index(drop=True, inplace=True)
-
-    NP = df_tmp['rolling_average'].apply(lambda x: x ** 4)
-
-    NP = NP.mean()
-
-    return NP ** 0.25
-
-
-def build_df_from_raw(content):
-    data = parse_content(content)
-
-    df = build_df(data['ride'], data['events'])
-
-    return df
-
-
+    return messages
+
+
+@timed('decode')
+def read_records_fit(fit_raw_data, engine=None):
+    """
+    Decode the record and event messages with the configured engine, 'fast' (fit_decoder) or 'sdk'
+    (garmin_fit_sdk). The SDK is used as well when the fast engine cannot read the file.
+    :return: the records, as a list of dicts or a dict of columns, the events and the number of records
+    """
+    if engine is None:
+        engine = config.get('ingest', 'engine', fallback='fast')
+
+    if engine == 'fast':
+        try:
+            records, events = read_records(fit_raw_data)
+            return records, events, max((len(values) for values in records.values()), default=0)
+        except Exception as e:
+            logger.warning(f'Fast FIT decoder failed ({type(e).__name__}: {e}), using garmin_fit_sdk')
+
+    messages = decode_fit(fit_raw_data)
+    records = messages.get('record_mesgs', [])
+    return records, messages.get('event_mesgs', []), len(records)
+
+
+# Columns of the ride DataFrames and their dtypes, an integer column is float32 when it misses samples
+RIDE_SCHEMA = {
+    'timestamp': np.int64,  # epoch seconds
+    'position_lat': np.float32,  # degrees
+    'position_long': np.float32,
+    'distance': np.int32,  # meters
+    'altitude': np.float32,
+    'speed': np.float32,  # Km/h
+    'power': np.uint16,
+    'heart_rate': np.uint8,
+    'is_start': bool,
+}
+# Version of RIDE_SCHEMA, part of the ride cache keys so rides cached with an older schema are decoded again
+RIDE_SCHEMA_VERSION = 2
+
+
+def compact_column(values, dtype):
+    values = pd.Series(values)
+    if np.issubdtype(dtype, np.integer) and values.isna().any():
+        return values.astype(np.float32)
+    return values.astype(dtype)
+
+
+@timed('build_df')
 def build_df(record_msg, events_msg):
     # st.write('build_df')
     df = pd.DataFrame(record_msg)
 
-    df['is_start'] = False
-
     # values without gps coordinates are uselss
     df.dropna(subset=["timestamp", "position_long", "position_lat", "distance", "enhanced_speed"], inplace=True)
     df.reset_index(drop=True, inplace=True)
 
-    # Transform into degrees
-    df["position_long"] = (df["position_long"] / 11930465)
-    df["position_lat"] = (df["position_lat"] / 11930465)
-
-    df["rounded_long"] = df["position_long"].round(N_DECIMALS)
-    df["rounded_lat"] = df["position_lat"].round(N_DECIMALS)
-
-    # Transorm from m/s to Km/h
-    df["speed"] = (df['enhanced_speed'] * 3.6).round(1)
-
-    # Distance in meters
-    df["distance"] = (df["distance"]).round().astype(int)
+    ride = pd.DataFrame({
+        'timestamp': epoch_seconds(df['timestamp']),
+        # Transform into degrees
+        'position_lat': df['position_lat'] / 11930465,
+        'position_long': df['position_long'] / 11930465,
+        # Distance in meters
+        'distance': df['distance'].round(),
+        # Transorm from m/s to Km/h
+        'speed': (df['enhanced_speed'] * 3.6).round(1),
+    })
+    # Only the columns the app uses are kept, the others fields of the records are dropped
+    for column in ('altitude', 'power', 'heart_rate'):
+        if column in df.columns:
+            ride[column] = df[column].to_numpy()
 
     start_hours = [msg['timestamp'].timestamp() for msg in events_msg if
                    (msg['event'] == 'timer' and msg['event_type'] == 'start')]
 
-    df['is_start'] = df['timestamp'].apply(lambda x: x.timestamp() in start_hours)
-    df.loc[0, 'is_start'] = True
+    ride['is_start'] = np.isin(ride['timestamp'], start_hours)
+    ride.loc[0, 'is_start'] = True
+
+    return pd.DataFrame({column: compact_column(ride[column], dtype)
+                         for column, dtype in RIDE_SCHEMA.items() if column in ride.columns})
 
-    return df
 
+def ride_memory_report(rides):
+    """
+    :return: DataFrame with the rows and bytes of every ride, in total and for each column
+    """
+    report = []
+    for name, df in rides.items():
+        column_bytes = df.memory_usage(index=False, deep=True)
+        row = {'name': name, 'rows': len(df), 'bytes': int(column_bytes.sum()),
+               'bytes per row': round(column_bytes.sum() / max(len(df), 1), 1)}
+        row.update({f'{column} bytes': int(nbytes) for column, nbytes in column_bytes.items()})
+        report.append(row)
+    return pd.DataFrame(report)
 
 
-def build_htmlTable(df):
+def build_htmlTable(df, title='Results'):
     component = html.Div([
-        html.H2('Results'),
+        html.H2(title),
         dash_table.DataTable(data=df.to_dict('records'), columns=[{'name': i, 'id': i} for i in df.columns],
                              style_table={'overflowX': 'auto'})
     ])
     return component
 
 
-def add_cs(df, period_list):
-    for period in period_list:
-        if 'power' in df.columns:
-            df[f'cs {period}'] = df['power'].rolling(period * 60).mean()
-        else:
-            df[f'cs {period}'] = 0
-    return df
+def build_gap_table(marks, gaps, riders, every=5):
+    """
+    Time gap to the leader, in seconds, every few kilometres and at the last kilometre of the leader
+    """
+    columns = [i for i in range(len(marks)) if (i + 1) % every == 0]
+    if len(marks) and len(marks) - 1 not in columns:
+        columns.append(len(marks) - 1)
+
+    gaps = np.asarray(gaps, dtype=float)
+    data = {'name': list(riders)}
+    for i in columns:
+        # Whole seconds, missing for the riders that did not reach the mark
+        missing = np.isnan(gaps[:, i])
+        seconds = np.round(np.where(missing, 0, gaps[:, i])).astype(np.int64)
+        data[f'km {marks[i] / 1000:g}'] = pd.arrays.IntegerArray(seconds, missing)
+
+    return pd.DataFrame(data)
+
+
+def build_upload_status(rides, errors):
+    component = [html.P(f'{len(rides)} rides loaded')]
+    if errors:
+        component.append(html.Ul([html.Li(f'{name}: {error}') for name, error in errors.items()]))
+    return component
 
 
-def build_metrics(riders_data, weight_ftp):
+@timed('build_metrics')
+def build_metrics(riders_data, weight_ftp, power_curve=None, w_balance=None, summaries=None):
+    """
+    :param power_curve: (durations, {rider: best average power}) already computed for the rides, with at least
+    the TABLE_DURATIONS shorter than each ride
+    :param w_balance: {rider: (W' balance every second, W')} as given by matrix_w_prime_balance, adds the W' balance
+    columns, empty for the riders not in it
+    :param summaries: RideSummaries of the rides with the same riders data, when already computed
+    """
     data = []
-    for rider, rider_data in riders_data.items():
-        if rider not in weight_ftp.keys():
-            ftp = 1
-            weight = 1
-        else:
-            ftp = weight_ftp[rider]['ftp']
-            weight = weight_ftp[rider]['weight']
-
-        df = pd.DataFrame(rider_data)
-        df.timestamp = pd.to_datetime(df.timestamp)
-
-        df = add_best_power_values(df, [30, 60, 600, 1200, 3600])
-        df = add_cs(df, [1, 5, 12])
-        NP = compute_avg_NP(df)
-        df['above FTP'] = df['power'].apply(lambda x: 1 if x > ftp else 0)
-        AP_FTP = (df['above FTP'].sum() / df.shape[0]) * 100
-        df['w is 0'] = df['power'].apply(lambda x: 1 if x <= 30 else 0)
-        coasting = (df['w is 0'].sum() / df.shape[0]) * 100
-        duration = df['timestamp'].iloc[-1] - df['timestamp'].iloc[0]
+    # Best average power for the table durations, on the 1-second grid of the rides
+    durations, curves = power_curve if power_curve is not None else power_curves(riders_data, TABLE_DURATIONS)
+    if summaries is None:
+        summaries = summarize_rides(riders_data, weight_ftp)
+    for i, rider in enumerate(riders_data):
+        # The riders data may only have cp and w_prime or lthr, the ones without ftp or weight get 1
+        rider_data = weight_ftp.get(rider) or {}
+        ftp = rider_data.get('ftp') or 1
+        weight = rider_data.get('weight') or 1
+
+        best = dict(zip(durations, curves[rider]))
+        best = {duration: best.get(duration, np.nan) for duration in TABLE_DURATIONS}
+        NP = summaries.normalized_power[i]
+        work = summaries.work[i]
+        duration = timedelta(seconds=int(summaries.seconds[i]))
         hours = duration.seconds // 3600
         minutes = (duration.seconds - hours * 3600) // 60
         seconds = duration.seconds - hours * 3600 - minutes * 60
         duration_str = f'{hours}:{minutes:02d}:{seconds:02d}'
         row = {
-            'name': rider, 'time': duration_str, 'Pos': None, 'Coasting': coasting,
-            'distance': df['distance'].iloc[-1] / 1000,
-            'Avg Speed': df['speed'].mean(), 'Avg Power': df['power'].mean(), 'NP': NP, 'IF': NP / ftp,
-            'AP  FTP': AP_FTP,
-            'Work (Kj)': df['power'].sum() * 0.001, 'Power/kg': df['power'].mean() / weight, 'NP/kg': NP / weight,
-            'Kj/kg': df['power'].sum() * 0.001 / weight, 'Pmax': None, 'Best 30" ': df['Best 30"'].max(),
-            "Best 1'  ": df['Best 60"'].max(), "Best 10' ": df['Best 600"'].max(), "Best 20' ": df['Best 1200"'].max(),
-            "Best 60' ": df['Best 3600"'].max(), "CS 1' ": (df['cs 1'].max() ** 2) / weight,
-            "CS 5' ": (df['cs 5'].max() ** 2) / weight,
-            "CS 12' ": (df['cs 12'].max() ** 2) / weight,
-            'Avg HR': df['heart_rate'].mean() if 'heart_rate' in df.columns else 0
+            'name': rider, 'time': duration_str, 'Pos': None, 'Coasting': summaries.coasting[i],
+            'distance': riders_data[rider]['distance'].iloc[-1] / 1000,
+            'Avg Speed': riders_data[rider]['speed'].mean(), 'Avg Power': summaries.average_power[i], 'NP': NP,
+            'IF': NP / ftp, 'TSS': summaries.seconds[i] * (NP / ftp) ** 2 / 36, 'AP  FTP': summaries.above_ftp[i],
+            'Work (Kj)': work, 'Power/kg': summaries.average_power[i] / weight, 'NP/kg': NP / weight,
+            'Kj/kg': work / weight, 'Pmax': None, 'Best 30" ': best[30],
+            "Best 1'  ": best[60], "Best 10' ": best[600], "Best 20' ": best[1200],
+            "Best 60' ": best[3600], "CS 1' ": (best[60] ** 2) / weight,
+            "CS 5' ": (best[300] ** 2) / weight,
+            "CS 12' ": (best[720] ** 2) / weight,
+            'Avg HR': summaries.average_heart_rate[i] if 'heart_rate' in riders_data[rider].columns else 0
         }
+        if w_balance is not None:
+            row.update(w_balance_columns(*w_balance.get(rider, (None, None))))
         for k, v in row.items():
             if k != 'name' and k != 'time' and v is not None:
-                row[k] = round(v, 2)
+                row[k] = round(float(v), 2)
         data.append(row)
     df2show = pd.DataFrame(data)
     return df2show
 
 
-def add_kilojoules_per_hour(df):
-    df.timestamp = pd.to_datetime(df.timestamp)
-    df['kilojoules'] = df['power'] * 0.001
-    tmp_df = df[['timestamp', 'kilojoules']].copy()
-    tmp_df = tmp_df.set_index('timestamp')
-    tmp_df.index = pd.to_datetime(tmp_df.index)
-    tmp_df = tmp_df.rolling(window=timedelta(hours=1), min_periods=1).sum()
-    df['kilojoules_last_hour'] = tmp_df['kilojoules'].values
-    return df
+def w_balance_columns(balance, w_prime):
+    """
+    Lowest W' balance and minutes spent below W_BALANCE_THRESHOLDS of W'
+    """
+    columns = {"Min W'bal (kJ)": np.nan}
+    columns.update({f"W'bal<{threshold:.0%} (min)": np.nan for threshold in W_BALANCE_THRESHOLDS})
+    if balance is None:
+        return columns
+    balance = balance[~np.isnan(balance)]
+    if len(balance):
+        columns["Min W'bal (kJ)"] = balance.min() / 1000
+        for threshold in W_BALANCE_THRESHOLDS:
+            columns[f"W'bal<{threshold:.0%} (min)"] = np.count_nonzero(balance < threshold * w_prime) / 60
+    return columns
+
+
+def overlapping_rides(rides, errors):
+    """
+    Keep the largest group of rides that overlap in time (see alignment.ride_groups), the other rides are
+    from another day or event and go to the errors
+    :return: the rides kept and the errors
+    """
+    groups = ride_groups({name: (df['timestamp'].iloc[0], df['timestamp'].iloc[-1])
+                          for name, df in rides.items() if not df.empty})
+    errors = dict(errors)
+    for group in groups[1:]:
+        for name in group:
+            errors[name] = f'more than {MAX_GRID_GAP // 60} minutes away from the rides of {groups[0][0]}'
+    kept = set(groups[0]) if groups else set()
+    return {name: df for name, df in rides.items() if name in kept}, errors
+
+
+def latest_start(rides):
+    """
+    :return: the latest first timestamp of the rides, they can only be compared from there
+    """
+    return pd.Timestamp(max(df['timestamp'].iloc[0] for df in rides.values()), unit='s', tz='UTC')
+
+
+def ride_starts(rides, hour, minute, seconds):
+    """
+    First row of every ride at the start time, found with a binary search on the sorted timestamps
+    :return: {name: (first row, distance at the first row)}, without the riders that finished before the start
+    """
+    starts = {}
+    for name, df in rides.items():
+        timestamps = df['timestamp'].to_numpy()
+        start_timestamp = pd.Timestamp(timestamps[0], unit='s', tz='UTC')
+        start_timestamp = start_timestamp.replace(hour=int(hour), minute=int(minute), second=int(seconds))
+
+        first_row = int(np.searchsorted(timestamps, start_timestamp.timestamp(), side='left'))
+        if first_row < len(timestamps):
+            starts[name] = (first_row, df['distance'].iloc[first_row])
+    return starts
+
+
+def correct_starts(rides, starts):
+    """
+    :return: the rides from their first row, with the distance counted from there, as views of the rides
+    """
+    return {name: slice_frame(rides[name], first_row, {'distance': offset})
+            for name, (first_row, offset) in starts.items()}
+
+
+def ride_name(filename):
+    suffix = '.fit.gz'
+    if filename.endswith(suffix):
+        filename = filename[:-len(suffix)].lower()
+    return filename
 
 
-def parse_contents(content_files, filenames):
-    data = {}
-    suffix = '.fit.gz'
-    for content, name in zip(content_files, filenames):
-        if name.endswith(suffix):
-            name = name[:-len(suffix)].lower()
+def build_ride(fit_raw_data):
+    records, events, n_records = read_records_fit(fit_raw_data)
+
+    if n_records <= 3:
+        raise ValueError('The file does not contain enough records')
+
+    return build_df(records, events)
 
-        content_type, content_string = content.split(',')
 
-        decoded = base64.b64decode(content_string)
+def decode_ride(content):
+    """
+    Decode one uploaded fit.gz file and build its ride DataFrame, runs inside the worker processes
+    :return: the ride DataFrame
+    """
+    return build_ride(decompress_content(content))
 
-        fit_raw_data = gzip.decompress(decoded)
 
-        stream = Stream.from_byte_array(fit_raw_data)  # Stream.from_byte_array(io.BytesIO(decoded))
-        decoder = Decoder(stream)
-        messages, errors = decoder.read()
+def decode_ride_file(path):
+    """
+    Same as decode_ride for a fit.gz file saved on disk by the raw upload route
+    """
+    return build_ride(decompress_file(path))
+
+
+def iter_rides(content_files, filenames, max_workers=None, cache=None):
+    """
+    Decode the uploaded files in a process pool, yielding (name, ride_df, error) as each file finishes.
+    Only one of ride_df and error is set, so a broken file does not stop the rest of the upload.
+    Files already in the cache (a storage.RideCache) are not decoded again.
+    """
+    return iter_decoded(content_files, filenames, content_key, decode_ride, max_workers, cache)
+
+
+def iter_ride_files(paths, filenames, max_workers=None, cache=None):
+    return iter_decoded(paths, filenames, path_key, decode_ride_file, max_workers, cache)
+
+
+def iter_decoded(sources, filenames, key_function, decode, max_workers=None, cache=None):
+    pending = []
+    for source, name in zip(sources, filenames):
+        name = ride_name(name)
+        try:
+            key = f'{key_function(source)}-{RIDE_SCHEMA_VERSION}'
+        except Exception as e:
+            yield name, None, f'{type(e).__name__}: {e}'
+            continue
+
+        ride_df = cache.get(key) if cache is not None else None
+        if ride_df is not None:
+            yield name, ride_df, None
+        else:
+            pending.append((source, name, key))
+
+    if max_workers is None:
+        max_workers = config.getint('ingest', 'max_workers', fallback=0)
+    max_workers = min(max_workers or os.cpu_count() or 1, len(pending))
+
+    if max_workers <= 1:
+        # Not worth starting a pool for a single file
+        for source, name, key in pending:
+            try:
+                ride_df = decode(source)
+            except Exception as e:
+                yield name, None, f'{type(e).__name__}: {e}'
+                continue
+            if cache is not None:
+                cache.put(key, ride_df.copy())
+            yield name, ride_df, None
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(call_with_spans, decode, source): (name, key) for source, name, key in pending}
+        for future in as_completed(futures):
+            name, key = futures[future]
+            try:
+                ride_df, spans = future.result()
+                record_spans(spans)
+            except Exception as e:
+                yield name, None, f'{type(e).__name__}: {e}'
+                continue
+            if cache is not None:
+                cache.put(key, ride_df.copy())
+            yield name, ride_df, None
+
+
+def load_rides(content_files, filenames, max_workers=None, cache=None, progress=None):
+    """
+    :param progress: called with (files done, total files) every time a file finishes
+    :return: rides as {name: ride_df} in upload order and the failed files as {name: error message}
+    """
+    return collect_rides(iter_rides(content_files, filenames, max_workers, cache), filenames, progress)
+
+
+def load_ride_files(paths, filenames, max_workers=None, cache=None, progress=None):
+    return collect_rides(iter_ride_files(paths, filenames, max_workers, cache), filenames, progress)
+
+
+def collect_rides(results, filenames, progress=None):
+    rides = {}
+    errors = {}
+    for i, (name, ride_df, error) in enumerate(results):
+        if error is None:
+            rides[name] = ride_df
+        else:
+            errors[name] = error
+        if progress is not None:
+            progress(i + 1, len(filenames))
+
+    if rides:
+        logger.info('Memory of the rides\n' + ride_memory_report(rides).to_string(index=False))
 
-        if len(messages['record_mesgs']) > 3:
-            data[name] = {
-                'ride': messages['record_mesgs'],
-                'events': messages['event_mesgs']
-            }
+    order = [ride_name(name) for name in filenames]
+    rides = {name: rides[name] for name in order if name in rides}
 
-    return data
\ No newline at end of file
+    return rides, errors
@@ -0,0 +1,225 @@
+"""
+Process a season of races without the Dash UI, one race per folder.
+
+    python src/batch.py races/ results/ --formats csv,xlsx --workers 4
+
+Every folder of races/ with fit.gz files is a race. The riders YAML (weight and ftp of every rider, and
+optionally cp, w_prime, lthr or max_hr, as uploaded in the UI) is the first *.yaml or *.yml of the race
+folder or of the closest parent folder. The results of races/a/b go to results/a/b: the comparative
+table, the gap table to the leader, the time in zones and the figures as static HTML; with --catalog
+the rides are also added to the ride catalog (see catalog.py). A race already processed with the same
+files and options is skipped, so an interrupted run continues where it stopped.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import yaml
+
+from aux import load_ride_files, latest_start, ride_starts, correct_starts, build_metrics, build_gap_table
+from alignment import time_gaps
+from catalog import RideCatalog
+from config import config
+from features import RideFeatures
+from figures import build_leader_figure, build_speed_figure, build_kilojoules_figure, build_power_curve_figure, \
+    build_w_balance_figure
+from power import matrix_w_prime_balance
+from summary import summarize_rides, build_zones_table
+
+DONE_FILE = 'batch.json'
+ERROR_FILE = 'error.txt'
+
+# Format: (module pandas needs to write it, extension)
+FORMATS = {'csv': (None, 'csv'), 'xlsx': ('openpyxl', 'xlsx'), 'parquet': ('pyarrow', 'parquet')}
+
+
+def find_races(root):
+    """
+    :return: {race folder: (fit.gz files, riders YAML or None)}
+    """
+    races = {}
+    root = os.path.abspath(root)
+    for directory, folders, files in os.walk(root):
+        folders.sort()
+        fit_files = sorted(os.path.join(directory, name) for name in files if name.endswith('.fit.gz'))
+        if fit_files:
+            races[directory] = (fit_files, find_riders_file(directory, root))
+    return races
+
+
+def find_riders_file(directory, root):
+    while True:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(('.yaml', '.yml')):
+                return os.path.join(directory, name)
+        if os.path.samefile(directory, root):
+            return None
+        directory = os.path.dirname(directory)
+
+
+def fingerprint(paths, options):
+    """
+    Hash of the input files (path, size and modification time) and the options of a race
+    """
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode())
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f'{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode())
+    return digest.hexdigest()
+
+
+def write_tables(tables, output, formats):
+    for file_format in formats:
+        if file_format == 'xlsx':
+            with pd.ExcelWriter(os.path.join(output, 'tables.xlsx')) as writer:
+                for name, table in tables.items():
+                    table.to_excel(writer, sheet_name=name, index=False)
+            continue
+        for name, table in tables.items():
+            path = os.path.join(output, f'{name}.{FORMATS[file_format][1]}')
+            if file_format == 'csv':
+                table.to_csv(path, index=False)
+            else:
+                table.to_parquet(path, index=False)
+
+
+def process_race(fit_files, riders_file, output, options):
+    """
+    Same steps as the UI: decode the files, correct the start time, build the tables and the figures
+    :return: the names of the riders
+    """
+    names = [os.path.basename(path) for path in fit_files]
+    rides, errors = load_ride_files(fit_files, names, max_workers=1)
+    if errors:
+        raise ValueError('; '.join(f'{name}: {error}' for name, error in errors.items()))
+
+    riders_data = {}
+    if riders_file is not None:
+        with open(riders_file) as f:
+            riders_data = yaml.safe_load(f) or {}
+    if options.get('catalog'):
+        RideCatalog().add_rides(rides, riders_data)
+
+    if options['start'] is None:
+        start = latest_start(rides)
+        hour, minute, seconds = start.hour, start.minute, start.second
+    else:
+        hour, minute, seconds = (int(value) for value in options['start'].split(':'))
+    features = RideFeatures(correct_starts(rides, ride_starts(rides, hour, minute, seconds)))
+
+    leader = options['leader'] if options['leader'] in features.rides else next(iter(features.rides))
+    marks, gaps = time_gaps(features.matrix, leader)
+    w_balance = matrix_w_prime_balance(features.matrix, riders_data)
+    summaries = summarize_rides(features.rides, riders_data)
+    tables = {
+        'metrics': build_metrics(features.rides, riders_data, (features.power_durations, features.power_curves),
+                                 w_balance, summaries),
+        'gaps': build_gap_table(marks, gaps, features.matrix.riders),
+        'zones': build_zones_table(summaries),
+    }
+    write_tables(tables, output, options['formats'])
+
+    figures = {
+        'leader': build_leader_figure(features, leader),
+        'speed': build_speed_figure(features),
+        'kilojoules': build_kilojoules_figure(features),
+        'power_curve': build_power_curve_figure(features),
+    }
+    if w_balance:
+        figures['w_balance'] = build_w_balance_figure(features, w_balance)
+    for name, fig in figures.items():
+        fig.write_html(os.path.join(output, f'{name}.html'), include_plotlyjs='cdn')
+
+    return list(features.rides)
+
+
+def run_race(race, fit_files, riders_file, output, options):
+    """
+    Process one race in a worker process, recording it as done or its error in the output folder
+    :return: (race, seconds, error message or None)
+    """
+    start = time.perf_counter()
+    os.makedirs(output, exist_ok=True)
+    done_path = os.path.join(output, DONE_FILE)
+    error_path = os.path.join(output, ERROR_FILE)
+    inputs = fit_files + ([riders_file] if riders_file else [])
+    try:
+        riders = process_race(fit_files, riders_file, output, options)
+    except Exception as e:
+        with open(error_path, 'w') as f:
+            f.write(f'{type(e).__name__}: {e}\n')
+        return race, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+    if os.path.exists(error_path):
+        os.remove(error_path)
+    seconds = time.perf_counter() - start
+    with open(done_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint(inputs, options), 'riders': riders, 'seconds': round(seconds, 3)}, f)
+    return race, seconds, None
+
+
+def is_done(output, inputs, options):
+    try:
+        with open(os.path.join(output, DONE_FILE)) as f:
+            return json.load(f)['fingerprint'] == fingerprint(inputs, options)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('races', help='folder with one folder of fit.gz files per race')
+    parser.add_argument('output', help='folder for the results, with the same tree as races')
+    parser.add_argument('--formats', default='csv', help='tables as any of csv, xlsx, parquet (default csv)')
+    parser.add_argument('--start', help='start time HH:MM:SS (UTC) of every race, default the latest start')
+    parser.add_argument('--leader', help='leader of the gap table and figure, default the first rider')
+    parser.add_argument('--workers', type=int, default=None, help='races processed at once, default one per CPU')
+    parser.add_argument('--catalog', action='store_true', help='add the rides to the ride catalog too')
+    parser.add_argument('--force', action='store_true', help='process again the races already done')
+    args = parser.parse_args(argv)
+
+    formats = [file_format.strip() for file_format in args.formats.split(',') if file_format.strip()]
+    for file_format in formats:
+        if file_format not in FORMATS:
+            parser.error(f'unknown format {file_format}, use {", ".join(FORMATS)}')
+        module = FORMATS[file_format][0]
+        if module is not None and importlib.util.find_spec(module) is None:
+            parser.error(f'{file_format} needs the {module} package')
+    options = {'formats': formats, 'start': args.start, 'leader': args.leader, 'catalog': args.catalog}
+
+    races = find_races(args.races)
+    pending = []
+    for race, (fit_files, riders_file) in races.items():
+        output = os.path.join(args.output, os.path.relpath(race, os.path.abspath(args.races)))
+        inputs = fit_files + ([riders_file] if riders_file else [])
+        if not args.force and is_done(output, inputs, options):
+            continue
+        pending.append((race, fit_files, riders_file, output, options))
+    print(f'{len(races)} races, {len(races) - len(pending)} already done')
+
+    workers = args.workers or config.getint('ingest', 'max_workers', fallback=0) or os.cpu_count() or 1
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(pending) or 1))) as executor:
+        futures = [executor.submit(run_race, *race) for race in pending]
+        for i, future in enumerate(as_completed(futures)):
+            race, seconds, error = future.result()
+            name = os.path.relpath(race, os.path.abspath(args.races))
+            if error is None:
+                print(f'[{i + 1}/{len(pending)}] {name} done in {seconds:.1f} s')
+            else:
+                failed += 1
+                print(f'[{i + 1}/{len(pending)}] {name} FAILED: {error}')
+
+    print(f'{len(pending) - failed} races processed, {failed} failed in {time.perf_counter() - start:.1f} s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
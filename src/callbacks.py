@@ -1,19 +1,36 @@
-from dash import callback, Output, Input, State
+from dash import callback, clientside_callback, ClientsideFunction, Output, Input, State, no_update
 import dash_leaflet as dl
 
 import base64
-import yaml
-import pandas as pd
-from datetime import datetime
-from layout import create_layout
-from aux import build_htmlTable, build_metrics, add_kilojoules_per_hour, parse_contents, build_df
+import functools
+import logging
+from aux import build_htmlTable, build_metrics, load_rides, load_ride_files, build_upload_status, build_gap_table, \
+    latest_start, ride_starts, overlapping_rides
 import uuid
-from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 
 from components.memory import MemoryRides
+from alignment import time_gaps
+from features import FeatureCache
+from instrumentation import timed
+from figures import build_leader_figure, build_speed_figure, build_kilojoules_figure, build_power_curve_figure, \
+    build_w_balance_figure, build_leader_data, relayout_range, secondary_y_figure
+from power import matrix_w_prime_balance
+from summary import summarize_rides, build_zones_table
+from storage import RideCache, ResultCache, json_key
+from catalog import RideCatalog
+from uploads import read_upload, remove_upload
+from export import write_workbook, new_export_path
+
+logger = logging.getLogger(__name__)
 
 rides_memory = MemoryRides()
+ride_cache = RideCache()
+ride_features = FeatureCache()
+ride_catalog = RideCatalog()
+result_cache = ResultCache()
+# Part of the result cache keys, a new version when a builder of the Process button gives a different result
+RESULTS_VERSION = 6
 
 
 #################
@@ -21,27 +38,79 @@ rides_memory = MemoryRides()
 ################
 @callback(Output('leader-dropdown', 'options'),
           Output('memory-rides-key', 'data'),
+          Output('upload-status', 'children'),
           Input('upload-fit-data', 'contents'),
           State('upload-fit-data', 'filename'),
+          State('memory-riders-data', 'data'),
+          background=True,
+          progress=[Output('upload-progress', 'value'), Output('upload-progress', 'max')],
+          running=[(Output('upload-progress', 'style'), {'width': '100%'}, {'display': 'none'})],
           prevent_initial_call=True)
-def update_data(list_of_contents, list_of_names):
+def update_data(set_progress, list_of_contents, list_of_names, riders_data):
     global rides_memory
 
     mem_key = ''
+    status = []
 
     if list_of_contents is not None:
         mem_key = str(uuid.uuid4())
-        data = parse_contents(list_of_contents, list_of_names)
-
-        rides = {}
-        for name, info in data.items():
-            rides[name] = build_df(info['ride'], info['events'])
+        rides, errors = load_rides(list_of_contents, list_of_names, cache=ride_cache,
+                                   progress=lambda done, total: set_progress((done, total)))
 
+        # Every ride goes to the catalog, only the ones that overlap can be compared
+        add_to_catalog(rides, riders_data)
+        rides, errors = overlapping_rides(rides, errors)
         list_of_names = list(rides.keys())
 
         rides_memory.set_rides(mem_key, rides)
 
-    return list_of_names, mem_key
+        status = build_upload_status(rides, errors)
+
+    return list_of_names, mem_key, status
+
+
+@callback(Output('leader-dropdown', 'options', allow_duplicate=True),
+          Output('memory-rides-key', 'data', allow_duplicate=True),
+          Output('upload-status', 'children', allow_duplicate=True),
+          Input('memory-upload-key', 'data'),
+          State('memory-riders-data', 'data'),
+          background=True,
+          progress=[Output('upload-progress', 'value'), Output('upload-progress', 'max')],
+          running=[(Output('upload-progress', 'style'), {'width': '100%'}, {'display': 'none'})],
+          prevent_initial_call=True)
+def update_data_from_files(set_progress, upload_key, riders_data):
+    """
+    Same as update_data for the files posted to the raw upload route, decoded from disk
+    """
+    global rides_memory
+
+    if not upload_key:
+        return no_update, no_update, no_update
+
+    try:
+        paths, list_of_names = read_upload(upload_key)
+    except (KeyError, OSError, ValueError):
+        return no_update, no_update, 'Upload not found, please load again the rides'
+
+    try:
+        mem_key = str(uuid.uuid4())
+        rides, errors = load_ride_files(paths, list_of_names, cache=ride_cache,
+                                        progress=lambda done, total: set_progress((done, total)))
+    finally:
+        remove_upload(upload_key)
+    add_to_catalog(rides, riders_data)
+    rides, errors = overlapping_rides(rides, errors)
+    rides_memory.set_rides(mem_key, rides)
+
+    return list(rides.keys()), mem_key, build_upload_status(rides, errors)
+
+
+def add_to_catalog(rides, riders_data):
+    # The rides are already loaded, a catalog that cannot be written must not fail the upload
+    try:
+        ride_catalog.add_rides(rides, riders_data)
+    except Exception as e:
+        logger.warning(f'Rides not added to the catalog: {type(e).__name__}: {e}')
 
 
 @callback(
@@ -57,6 +126,7 @@ def update_riders_data(content, name):
         decoded = base64.b64decode(content_string)
 
         # Assuming the uploaded file is YAML
+        import yaml
         riders_dict = yaml.safe_load(decoded)
 
     return riders_dict
@@ -80,30 +150,24 @@ def update_start_time_div(rides_key):
     #start_time_seconds = 0
     #end_time_seconds = 0
     #marks = {}
-    min_timestamp = datetime.now().timestamp()
-    if rides is not None and rides != {}:
-        min_times = []
-        for rider, rider_df in rides.items():
-            i = 0
-            while rider_df.iloc[i]['timestamp'] is None:
-                i += 1
-
-            min_times.append(rider_df.iloc[i]['timestamp'])
+    if not rides:
+        # Every file failed to decode, there is no start time to show
+        return no_update, no_update, no_update
 
-        # We can compare only from the latest starting hour
-        min_timestamp = max(min_times)
+    # We can compare only from the latest starting hour
+    min_timestamp = latest_start(rides)
 
-        # Calculate the range for the slider
-        # Convert time to seconds from start of the day for simplicity
-        # start_time_seconds = min_timestamp.hour * 3600 + min_timestamp.minute * 60 + min_timestamp.second
-        # end_time_seconds = max_timestamp.hour * 3600 + max_timestamp.minute * 60 + max_timestamp.second
+    # Calculate the range for the slider
+    # Convert time to seconds from start of the day for simplicity
+    # start_time_seconds = min_timestamp.hour * 3600 + min_timestamp.minute * 60 + min_timestamp.second
+    # end_time_seconds = max_timestamp.hour * 3600 + max_timestamp.minute * 60 + max_timestamp.second
 
-        # marks = {
-        #     t: f"{t // 3600:02d}:{(t % 3600) // 60:02d}:{t % 60:02d}" for t in
-        #     range(start_time_seconds, end_time_seconds + 1, 900)
-        # }  # Marks every 15 minutes
+    # marks = {
+    #     t: f"{t // 3600:02d}:{(t % 3600) // 60:02d}:{t % 60:02d}" for t in
+    #     range(start_time_seconds, end_time_seconds + 1, 900)
+    # }  # Marks every 15 minutes
 
-        # memory['date'] = min_timestamp.date()
+    # memory['date'] = min_timestamp.date()
 
     return min_timestamp.hour, min_timestamp.minute, min_timestamp.second
 
@@ -111,64 +175,71 @@ def update_start_time_div(rides_key):
 @callback(
     Output('map', 'children'),
     Output('map', 'center'),
+    Output('memory-map-markers', 'data'),
+    Output('leader-dropdown', 'options', allow_duplicate=True),
+    Output('leader-dropdown', 'value', allow_duplicate=True),
     Input('start_hour_input', 'value'),
     Input('start_minutes_input', 'value'),
     Input('start_seconds_input', 'value'),
     State('memory-rides-key', 'data'),
+    State('memory-map-markers', 'data'),
+    State('leader-dropdown', 'value'),
     prevent_initial_call=True
 )
 #def correct_rides(n_clicks, rides, hour, minute, seconds):
-def correct_rides(hour, minute, seconds, rides_key):
+@timed('correct_rides')
+def correct_rides(hour, minute, seconds, rides_key, markers=None, leader=None):
     global rides_memory
 
-    rides = rides_memory.get_rides(rides_key)
+    if hour is None or minute is None or seconds is None:
+        # Input being edited
+        return (no_update,) * 5
 
-    corrected_rides = {}
+    rides = rides_memory.get_rides(rides_key)
 
     if rides is not None and rides != {}:
 
-        for name, df in rides.items():
-            start_timestamp = df.iloc[0]['timestamp']
-            start_timestamp = start_timestamp.replace(hour=hour, minute=minute, second=seconds)
-            df['valid'] = df['timestamp'].apply(lambda x: x.timestamp() >= start_timestamp.timestamp())
-
-            df_valid = df[df['valid']].reset_index().copy()
+        # Correct the starting distance reference
+        starts = ride_starts(rides, hour, minute, seconds)
+        new_markers = [[name, float(rides[name]['position_lat'].iloc[first_row]),
+                        float(rides[name]['position_long'].iloc[first_row])]
+                       for name, (first_row, _) in starts.items()]
 
-            # Correct the starting distance reference
-            offset = df_valid.iloc[0]['distance']
-            df_valid['distance'] = df_valid['distance'].apply(lambda x: x - offset)
+        # The corrected rides are views of the rides, only the first rows are stored
+        rides_memory.set_corrected_rides(rides_key, starts)
 
-            corrected_rides[name] = df_valid
+        if new_markers == markers:
+            return (no_update,) * 5
 
-        rides_memory.set_corrected_rides(rides_key, corrected_rides)
+        # The riders that finished before the start time are not in the corrected rides, they cannot lead
+        riders = list(starts)
+        return *update_map(new_markers), new_markers, riders, leader if leader in riders else None
 
-        return update_map(corrected_rides)
+    return (no_update,) * 5
 
 
-def update_map(rides):
+def update_map(markers):
+    """
+    :param markers: [name, latitude, longitude] of the start of every ride
+    """
     children = []
     center = (0, 0)
-    if (rides is not None) and (len(rides) > 0):
+    if (markers is not None) and (len(markers) > 0):
         #       rides_corrected = {name: pd.DataFrame(data) for name, data in rides.items()}
-        mean_starting_lat = sum([df["position_lat"].iloc[0] for _, df in rides.items()])
-        mean_starting_lat /= len(rides)
+        mean_starting_lat = sum([lat for _, lat, _ in markers])
+        mean_starting_lat /= len(markers)
 
-        mean_starting_long = sum([df["position_long"].iloc[0] for _, df in rides.items()])
-        mean_starting_long /= len(rides)
+        mean_starting_long = sum([long for _, _, long in markers])
+        mean_starting_long /= len(markers)
 
         center = (mean_starting_lat, mean_starting_long)
 
-        marker_coords = [
-            (df["position_lat"].iloc[0], df["position_long"].iloc[0])
-            for _, df in rides.items()
-        ]
-
         children = [
             dl.TileLayer(),  # Base layer that provides the map
             dl.LayerGroup([
-                dl.Marker(position=coord, children=[
+                dl.Marker(position=(lat, long), children=[
                     dl.Tooltip(f"{name}")
-                ]) for name, coord in zip(rides.keys(), marker_coords)
+                ]) for name, lat, long in markers
             ])
         ]
 
@@ -179,20 +250,93 @@ def update_map(rides):
 @callback(
     Output('output_table', 'children'),
     Output('memory-comparative_table', 'data', allow_duplicate=True),
+    Output('gap_table', 'children'),
+    Output('zones_table', 'children'),
+    Output('follow_the_leader_plot', 'figure'),
+    Output('follow_the_leader_plot', 'style'),
+    Output('memory-leader', 'data'),
+    Output('speed_comparison-graph', 'figure'),
+    Output('speed_comparison-graph', 'style'),
+    Output('kilojoules-graph', 'figure'),
+    Output('kilojoules-graph', 'style'),
+    Output('power_curve-graph', 'figure'),
+    Output('power_curve-graph', 'style'),
+    Output('w_balance-graph', 'figure'),
+    Output('w_balance-graph', 'style'),
+    Output('memory-leader-data', 'data'),
     Input('process-button', 'n_clicks'),
     State('memory-riders-data', 'data'),
     State('memory-rides-key', 'data'),
+    State('leader-dropdown', 'value'),
+    State('window-aggregate-dropdown', 'value'),
+    State('window-dropdown', 'value'),
+    background=True,
+    progress=[Output('process-progress', 'value'), Output('process-progress', 'max')],
+    running=[
+        (Output('process-button', 'disabled'), True, False),
+        (Output('process-progress', 'style'), {'width': '100%'}, {'display': 'none'}),
+    ],
+    # A new upload, through either upload path, makes the running job useless
+    cancel=[Input('memory-rides-key', 'data')],
     prevent_initial_call=True,
 )
-def update_comparative_table(n_clicks, riders_data, rides_key):
+def update_dashboard(set_progress, n_clicks, riders_data, rides_key, leader, aggregate, window):
+    """
+    Everything the Process button shows, built in a background job: the features of every rider, then
+    the tables and figures from them
+    """
     global rides_memory
-    rides = rides_memory.get_corrected_rides(rides_key)
 
+    builders = 9
+    riders = []
+
+    def rider_progress(done, total):
+        riders[:] = [total]
+        set_progress((done, total + builders))
+
+    # Only computed when a result is not in the cache
+    @functools.cache
+    def features():
+        return ride_features.get(rides_key, rides_memory, progress=rider_progress)
+
+    @functools.cache
+    def w_balance():
+        return matrix_w_prime_balance(features().matrix, riders_data)
+
+    @functools.cache
+    def summaries():
+        return summarize_rides(features().rides, riders_data)
+
+    # The content of the corrected rides includes the start time
+    content = (RESULTS_VERSION, rides_memory.content_key(rides_key, 'corrected_rides'))
+    riders_key = json_key(riders_data)
+
+    outputs = []
+    for i, (name, key, builder) in enumerate([
+        ('comparative_table', riders_key,
+         lambda: update_comparative_table(features(), riders_data, w_balance(), summaries())),
+        ('gap_table', leader, lambda: (update_gap_table(features(), leader),)),
+        ('zones_table', riders_key, lambda: (update_zones_table(summaries()),)),
+        ('leader_figure', leader, lambda: update_leader_comparative(features(), leader)),
+        ('speed_figure', None, lambda: update_speed_comparison(features())),
+        ('kilojoules_figure', (aggregate, window), lambda: update_kilojoules_per_hour(features(), aggregate, window)),
+        ('power_curve_figure', None, lambda: update_power_curve(features())),
+        ('w_balance_figure', riders_key, lambda: update_w_balance(features(), w_balance())),
+        ('leader_data', None, lambda: (build_leader_data(features()),)),
+    ]):
+        outputs.extend(result_cache.get_or_build(name, (content, key), builder))
+        set_progress((sum(riders) + i + 1, sum(riders) + builders))
+
+    return tuple(outputs)
+
+
+def update_comparative_table(features, riders_data, w_balance=None, summaries=None):
     table = []
     comparative_table = {}
 
-    if (rides is not None) and (riders_data is not None):
-        df_to_show = build_metrics(rides, riders_data)
+    if (features is not None) and (riders_data is not None):
+        df_to_show = build_metrics(features.rides, riders_data, (features.power_durations, features.power_curves),
+                                   w_balance, summaries)
         table = [build_htmlTable(df_to_show)]
 
         comparative_table = df_to_show.to_dict("records")
@@ -200,6 +344,23 @@ def update_comparative_table(n_clicks, riders_data, rides_key):
     return table, comparative_table
 
 
+@timed('gap_table')
+def update_gap_table(features, leader):
+    table = []
+
+    # A leader that finished before the start time is not in the corrected rides
+    if (features is not None) and (leader in features.matrix.index):
+        matrix = features.matrix
+        marks, gaps = time_gaps(matrix, leader)
+        table = [build_htmlTable(build_gap_table(marks, gaps, matrix.riders), title=f'Time gap to {leader} (s)')]
+
+    return table
+
+
+def update_zones_table(summaries):
+    return [build_htmlTable(build_zones_table(summaries), title='Time in zones (min)')]
+
+
 @callback(
     Output('download-table', 'style'),
     Input('output_table', 'children'),
@@ -210,156 +371,241 @@ def show_download_button(output_table):
 
 
 @callback(
-    Output('follow_the_leader_plot', 'figure'),
-    Output('follow_the_leader_plot', 'style'),
-    Input('process-button', 'n_clicks'),
+    Output('memory-export-key', 'data'),
+    Input('download-table', 'n_clicks'),
     State('memory-rides-key', 'data'),
-    State('leader-dropdown', 'value'),
+    State('memory-riders-data', 'data'),
+    background=True,
+    progress=[Output('download-progress', 'value'), Output('download-progress', 'max')],
+    running=[
+        (Output('download-table', 'disabled'), True, False),
+        (Output('download-progress', 'style'), {'width': '100%'}, {'display': 'none'}),
+    ],
+    cancel=[Input('memory-rides-key', 'data')],
     prevent_initial_call=True,
 )
-def update_leader_comparative(n_clicks, rides_key, leader):
+@timed('export')
+def export_table(set_progress, n_clicks, rides_key, riders_data):
+    """
+    Excel file with the comparative table and the time series of every rider, written to disk in a
+    background job and downloaded from the export route
+    """
     global rides_memory
-    rides = rides_memory.get_corrected_rides(rides_key)
 
-    fig = make_subplots(specs=[[{"secondary_y": True}]])  #go.Figure()
+    if not n_clicks or not rides_key:
+        return no_update
+
+    features = ride_features.get(rides_key, rides_memory)
+    table = build_metrics(features.rides, riders_data or {}, (features.power_durations, features.power_curves),
+                          matrix_w_prime_balance(features.matrix, riders_data))
+
+    export_key = str(uuid.uuid4())
+    write_workbook(new_export_path(export_key), table, features.rides,
+                   progress=lambda done, total: set_progress((done, total)))
+    return export_key
+
+
+# The browser downloads the file itself, it never goes through a callback response
+clientside_callback(
+    """
+    function(exportKey) {
+        if (!exportKey) {
+            return window.dash_clientside.no_update;
+        }
+        var config = document.getElementById('_dash-config');
+        var prefix = config ? (JSON.parse(config.textContent).requests_pathname_prefix || '/') : '/';
+        window.location.href = prefix + 'export/' + exportKey + '.xlsx';
+        return '';
+    }
+    """,
+    Output('download-status', 'children'),
+    Input('memory-export-key', 'data'),
+    prevent_initial_call=True,
+)
+
+
+def update_leader_comparative(features, leader):
+    fig = secondary_y_figure()  #go.Figure()
     style = {'display': 'none'}
 
-    if (rides is not None ) and (leader is not None ):
+    if (features is not None) and (leader in features.matrix.index):
         style = {'display': 'flex'}
-        # Initialize an empty DataFrame to store the differences
-        #differences_df = pd.DataFrame()
+        fig = build_leader_figure(features, leader)
+
+    return fig, style, leader
+
 
-        reference_df = rides[leader]
-        reference_df.timestamp = pd.to_datetime(reference_df.timestamp)
+def update_speed_comparison(features):
+    fig = secondary_y_figure()
+    style = {'display': 'none'}
+
+    if (features is not None) :
+        style = {'display': 'flex'}
+        fig = build_speed_figure(features)
 
-        #Add activity profile to the graph
+    return fig, style
 
-        fig.add_trace(
-            go.Scatter(x=reference_df.distance / 1000, y=reference_df.altitude, mode='lines', name='altitude'),
-            secondary_y=True
-        )
 
-        for rider, df in rides.items():
-            if rider != leader:
-                df.timestamp = pd.to_datetime(df.timestamp)
+def update_kilojoules_per_hour(features, aggregate='energy', window=3600):
+    fig = secondary_y_figure()  # go.Figure()
+    style = {'display': 'none'}
+    if features is not None :
+        style = {'display': 'flex'}
+        fig = build_kilojoules_figure(features, aggregate=aggregate, window=window)
 
-                max_length = min(df.shape[0], reference_df.shape[0])
+    return fig, style
 
-                differences = (
-                        df.iloc[:max_length]['distance'].values - reference_df.iloc[:max_length]['distance'].values
-                )
 
-                fig.add_trace(
-                    go.Scatter(x=reference_df.distance / 1000, y=differences, mode='lines', name=rider),
-                    secondary_y=False
-                )
+def update_power_curve(features):
+    fig = go.Figure()
+    style = {'display': 'none'}
+    if features is not None:
+        style = {'display': 'flex'}
+        fig = build_power_curve_figure(features)
 
-        fig.update_layout(
-            title_text=f"<b>Distance with respect to the Leader {leader}</b>"
-        )
+    return fig, style
 
-        # Set x-axis title
-        fig.update_xaxes(title_text="Distance (Km)")
 
-        # Set y-axes titles
-        fig.update_yaxes(title_text="Difference (meters)", secondary_y=False)
-        fig.update_yaxes(title_text="Altitude (meters)", secondary_y=True)
+def update_w_balance(features, w_balance):
+    fig = secondary_y_figure()
+    style = {'display': 'none'}
+    # Only the riders with ftp or cp in the riders data have a W' balance
+    if features is not None and w_balance:
+        style = {'display': 'flex'}
+        fig = build_w_balance_figure(features, w_balance)
 
     return fig, style
 
 
+##########################
+# Leader changed after Process
+
+
+# A new leader is drawn in the browser from the distances sent with the Process results, without a server request
+clientside_callback(
+    ClientsideFunction(namespace='cycling', function_name='leaderFigure'),
+    Output('follow_the_leader_plot', 'figure', allow_duplicate=True),
+    Output('follow_the_leader_plot', 'style', allow_duplicate=True),
+    Output('memory-leader', 'data', allow_duplicate=True),
+    Input('leader-dropdown', 'value'),
+    State('memory-leader-data', 'data'),
+    State('memory-leader', 'data'),
+    prevent_initial_call=True,
+)
+
+
 @callback(
-    Output('speed_comparison-graph', 'figure'),
-    Output('speed_comparison-graph', 'style'),
-    Input('process-button', 'n_clicks'),
+    Output('gap_table', 'children', allow_duplicate=True),
+    Input('leader-dropdown', 'value'),
     State('memory-rides-key', 'data'),
+    State('memory-leader-data', 'data'),
     prevent_initial_call=True,
 )
-def update_speed_comparison(n_clicks, rides_key):
+def switch_gap_table(leader, rides_key, leader_data):
+    """
+    Gap table of the leader drawn by leader.js, from the same result cache entry as the Process job
+    """
     global rides_memory
-    rides = rides_memory.get_corrected_rides(rides_key)
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    style = {'display': 'none'}
 
-    if (rides is not None) :
-        style = {'display': 'flex'}
-
-        profile_plotted = False
-        for rider, df in rides.items():
-            df.timestamp = pd.to_datetime(df.timestamp)
+    if not leader or not leader_data or leader not in leader_data['riders']:
+        return no_update
 
-            if not profile_plotted:
-                profile_plotted = True
-                fig.add_trace(
-                    go.Scatter(x=df['distance'] / 1000, y=df.altitude, mode='lines', name='Altitude'),
-                    secondary_y=True
-                )
+    content = (RESULTS_VERSION, rides_memory.content_key(rides_key, 'corrected_rides'))
+    table, = result_cache.get_or_build(
+        'gap_table', (content, leader),
+        lambda: (update_gap_table(ride_features.get(rides_key, rides_memory), leader),))
+    return table
 
-            fig.add_trace(
-                go.Scatter(x=df.distance / 1000, y=df.speed, mode='lines', name=rider),
-                secondary_y=False
-            )
 
-        # Add figure title
-        fig.update_layout(
-            title_text="<b>Speed</b>"
-        )
+##########################
+# Full resolution data of the zoomed range, the figures only hold decimated traces
 
-        # Set x-axis title
-        fig.update_xaxes(title_text="Distance (Km)")
 
-        # Set y-axes titles
-        fig.update_yaxes(title_text="Speed (Km/h)", secondary_y=False)
-        fig.update_yaxes(title_text="Altitude (meters)", secondary_y=True)
+@callback(
+    Output('follow_the_leader_plot', 'figure', allow_duplicate=True),
+    Input('follow_the_leader_plot', 'relayoutData'),
+    State('memory-rides-key', 'data'),
+    State('memory-leader', 'data'),
+    prevent_initial_call=True,
+)
+def zoom_leader_comparative(relayout_data, rides_key, leader):
+    x_range = relayout_range(relayout_data)
+    if x_range is no_update or not leader:
+        return no_update
 
-    return fig, style
+    return build_leader_figure(ride_features.get(rides_key, rides_memory), leader, x_range)
 
 
 @callback(
-    Output('kilojoules-graph', 'figure'),
-    Output('kilojoules-graph', 'style'),
-    Input('process-button', 'n_clicks'),
+    Output('speed_comparison-graph', 'figure', allow_duplicate=True),
+    Input('speed_comparison-graph', 'relayoutData'),
     State('memory-rides-key', 'data'),
-    prevent_initial_call=True
+    prevent_initial_call=True,
 )
-def update_kilojoules_per_hour(n_clicks, rides_key):
-    global rides_memory
-    rides = rides_memory.get_corrected_rides(rides_key)
+def zoom_speed_comparison(relayout_data, rides_key):
+    x_range = relayout_range(relayout_data)
+    if x_range is no_update:
+        return no_update
 
-    fig = make_subplots(specs=[[{"secondary_y": True}]])  # go.Figure()
-    style = {'display': 'none'}
-    if rides is not None :
-        style = {'display': 'flex'}
+    return build_speed_figure(ride_features.get(rides_key, rides_memory), x_range)
 
-        profile_plotted = False
-        dfs_with_kJ = {}
-        for rider, df in rides.items():
-            df = add_kilojoules_per_hour(df)
 
-            if not profile_plotted:
-                profile_plotted = True
-                fig.add_trace(
-                    go.Scatter(x=df['distance'] / 1000, y=df['altitude'], mode='lines', name='Altitude'),
-                    secondary_y=True
-                )
+@callback(
+    Output('kilojoules-graph', 'figure', allow_duplicate=True),
+    Input('kilojoules-graph', 'relayoutData'),
+    State('memory-rides-key', 'data'),
+    State('window-aggregate-dropdown', 'value'),
+    State('window-dropdown', 'value'),
+    prevent_initial_call=True,
+)
+def zoom_kilojoules_per_hour(relayout_data, rides_key, aggregate, window):
+    x_range = relayout_range(relayout_data)
+    if x_range is no_update:
+        return no_update
 
-            fig.add_trace(
-                go.Scatter(x=df['distance'] / 1000, y=df['kilojoules_last_hour'], mode='lines', name=rider),
-                secondary_y=False
-            )
+    return build_kilojoules_figure(ride_features.get(rides_key, rides_memory), x_range, aggregate, window)
 
-        # Add figure title
-        fig.update_layout(
-            title_text="<b> Spent energy in the last hour </b>"
-        )
 
-        # Set x-axis title
-        fig.update_xaxes(title_text="Distance (Km)")
+@callback(
+    Output('kilojoules-graph', 'figure', allow_duplicate=True),
+    Input('window-aggregate-dropdown', 'value'),
+    Input('window-dropdown', 'value'),
+    State('memory-rides-key', 'data'),
+    State('kilojoules-graph', 'style'),
+    State('kilojoules-graph', 'relayoutData'),
+    prevent_initial_call=True,
+)
+def select_window(aggregate, window, rides_key, style, relayout_data):
+    """
+    Every window is computed with the features, changing it only builds the figure again
+    """
+    # Nothing to show before the Process button
+    if not rides_key or (style or {}).get('display') == 'none':
+        return no_update
+
+    x_range = relayout_range(relayout_data)
+    if x_range is not no_update and x_range is not None:
+        return build_kilojoules_figure(ride_features.get(rides_key, rides_memory), x_range, aggregate, window)
+
+    # Same result as the Process button
+    content = (RESULTS_VERSION, rides_memory.content_key(rides_key, 'corrected_rides'))
+    figure, style = result_cache.get_or_build(
+        'kilojoules_figure', (content, (aggregate, window)),
+        lambda: update_kilojoules_per_hour(ride_features.get(rides_key, rides_memory), aggregate, window))
+    return figure
 
-        # Set y-axes titles
-        fig.update_yaxes(title_text="Energy (kJ)", secondary_y=False)
-        fig.update_yaxes(title_text="Altitude (meters)", secondary_y=True)
 
-    return fig, style
+@callback(
+    Output('w_balance-graph', 'figure', allow_duplicate=True),
+    Input('w_balance-graph', 'relayoutData'),
+    State('memory-rides-key', 'data'),
+    State('memory-riders-data', 'data'),
+    prevent_initial_call=True,
+)
+def zoom_w_balance(relayout_data, rides_key, riders_data):
+    x_range = relayout_range(relayout_data)
+    if x_range is no_update:
+        return no_update
 
+    features = ride_features.get(rides_key, rides_memory)
+    return build_w_balance_figure(features, matrix_w_prime_balance(features.matrix, riders_data), x_range)
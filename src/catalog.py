@@ -0,0 +1,265 @@
+"""
+Catalog of every ride loaded in the app or processed by batch.py, in a SQLite database of the storage
+directory. The summary row of the comparative table and the power curve of a ride are stored when it is
+loaded, so the season leaderboards and the history of a rider are indexed queries.
+
+    python src/catalog.py leaderboard NP --since 2024-03-01
+    python src/catalog.py best-power 1200 --since 2024-03-01 --until 2024-10-01
+    python src/catalog.py history rider0
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager, closing
+
+import pandas as pd
+
+from aux import build_metrics
+from config import config
+from instrumentation import timed
+from power import power_curves
+from storage import default_directory
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rides (
+    id INTEGER PRIMARY KEY,
+    rider TEXT NOT NULL,
+    start_time INTEGER NOT NULL,  -- epoch seconds, UTC
+    date TEXT NOT NULL,  -- YYYY-MM-DD, UTC
+    duration INTEGER NOT NULL,  -- seconds
+    distance REAL,  -- km
+    weight REAL,
+    ftp REAL,
+    avg_speed REAL,
+    avg_power REAL,
+    normalized_power REAL,
+    work REAL,  -- kJ
+    avg_heart_rate REAL,
+    summary TEXT NOT NULL,  -- row of build_metrics as JSON
+    added_at INTEGER NOT NULL,
+    UNIQUE (rider, start_time)
+);
+CREATE INDEX IF NOT EXISTS rides_start_time ON rides (start_time);
+CREATE TABLE IF NOT EXISTS power_curves (
+    ride_id INTEGER NOT NULL REFERENCES rides (id) ON DELETE CASCADE,
+    duration INTEGER NOT NULL,  -- seconds
+    power REAL NOT NULL,  -- best average power, W
+    PRIMARY KEY (ride_id, duration)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS power_curves_duration ON power_curves (duration, power);
+'''
+# user_version of the database: 1 when the power curves of the rides with dropped samples or recorded every
+# 2 s had no value for the longer durations, 2 since the seconds without power are bridged
+CURVE_VERSION = 2
+
+# Columns of the comparative table stored in their own column, the ones a leaderboard can be sorted by
+SUMMARY_COLUMNS = {
+    'distance': 'distance',
+    'Avg Speed': 'avg_speed',
+    'Avg Power': 'avg_power',
+    'NP': 'normalized_power',
+    'Work (Kj)': 'work',
+    'Avg HR': 'avg_heart_rate',
+}
+LEADERBOARD_COLUMNS = {**{column: column for column in SUMMARY_COLUMNS.values()},
+                       **SUMMARY_COLUMNS, 'duration': 'duration'}
+
+
+def default_path():
+    return config.get('catalog', 'path', fallback='') or os.path.join(default_directory('catalog'), 'catalog.sqlite')
+
+
+def epoch(date):
+    """
+    :return: epoch seconds of a date or timestamp string (UTC), None stays None
+    """
+    if date is None:
+        return None
+    return int(pd.Timestamp(date, tz='UTC').timestamp())
+
+
+def json_value(value):
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class RideCatalog:
+    """
+    Every process opens its own connection for each operation; the database is in WAL mode, so the
+    readers are not blocked by the upload job writing to it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.ready = False
+
+    @contextmanager
+    def connect(self):
+        """
+        Connection in a transaction, committed when the block ends without an exception
+        """
+        if not self.ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            connection.execute('PRAGMA foreign_keys = ON')
+            if not self.ready:
+                connection.execute('PRAGMA journal_mode = WAL')
+                self.upgrade(connection)
+                self.ready = True
+            with connection:
+                yield connection
+
+    def upgrade(self, connection):
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        connection.executescript(SCHEMA)
+        if version < CURVE_VERSION:
+            rides = connection.execute('SELECT COUNT(*) FROM rides').fetchone()[0]
+            if rides:
+                logger.warning(f'{rides} rides of the catalog {self.path} were added with power curves missing the '
+                               f'longer durations for the rides with dropped samples or 2 s recording; add the '
+                               f'files again (batch.py --catalog) to store their full power curves')
+            connection.execute(f'PRAGMA user_version = {CURVE_VERSION}')
+
+    @timed('catalog_add')
+    def add_rides(self, rides, riders_data=None):
+        """
+        Store the summary and the power curve of the rides as loaded, before any start time correction.
+        A ride already in the catalog (same rider and start time) is replaced.
+        :param riders_data: {rider: {'weight':, 'ftp':}}, the riders without it get the defaults of build_metrics
+        :return: the ids of the rides
+        """
+        riders_data = riders_data or {}
+        rows = []
+        for name, df in rides.items():
+            if df.empty:
+                continue
+            # One ride at a time: rides of other days must not be put on the same time grid
+            durations, curves = power_curves({name: df})
+            summary = build_metrics({name: df}, riders_data, (durations, curves)).iloc[0].to_dict()
+            summary = {key: json_value(value) for key, value in summary.items()}
+            start_time = int(df['timestamp'].iloc[0])
+            rider = riders_data.get(name) or {}
+            row = {
+                'rider': name,
+                'start_time': start_time,
+                'date': pd.Timestamp(start_time, unit='s', tz='UTC').strftime('%Y-%m-%d'),
+                'duration': int(df['timestamp'].iloc[-1]) - start_time,
+                'weight': rider.get('weight'),
+                'ftp': rider.get('ftp'),
+                'summary': json.dumps(summary),
+                'added_at': int(time.time()),
+                **{column: summary.get(key) for key, column in SUMMARY_COLUMNS.items()},
+            }
+            curve = [(int(duration), float(power)) for duration, power in zip(durations, curves[name])
+                     if not math.isnan(power)]
+            rows.append((row, curve))
+
+        ids = []
+        with self.connect() as connection:
+            for row, curve in rows:
+                connection.execute('DELETE FROM rides WHERE rider = ? AND start_time = ?',
+                                   (row['rider'], row['start_time']))
+                cursor = connection.execute(
+                    f'INSERT INTO rides ({", ".join(row)}) VALUES ({", ".join("?" * len(row))})',
+                    list(row.values()))
+                ride_id = cursor.lastrowid
+                connection.executemany('INSERT INTO power_curves (ride_id, duration, power) VALUES (?, ?, ?)',
+                                       [(ride_id, duration, power) for duration, power in curve])
+                ids.append(ride_id)
+        return ids
+
+    def query(self, sql, parameters=()):
+        with self.connect() as connection:
+            return pd.read_sql_query(sql, connection, params=parameters)
+
+    def rider_history(self, rider, since=None, until=None):
+        """
+        :return: the rides of a rider between the dates (included, UTC), the newest first
+        """
+        return self.query(
+            'SELECT date, start_time, duration, distance, avg_speed, avg_power, normalized_power, work, '
+            'avg_heart_rate, weight, ftp FROM rides WHERE rider = ? AND start_time >= ? AND start_time < ? '
+            'ORDER BY start_time DESC',
+            (rider, *self.time_range(since, until)))
+
+    def leaderboard(self, column, since=None, until=None, limit=20):
+        """
+        Best ride of every rider between the dates
+        :param column: one of LEADERBOARD_COLUMNS, as in the comparative table or as in the catalog
+        """
+        column = LEADERBOARD_COLUMNS[column]
+        return self.query(
+            f'SELECT rider, MAX({column}) AS {column}, date FROM rides '
+            f'WHERE start_time >= ? AND start_time < ? AND {column} IS NOT NULL '
+            f'GROUP BY rider ORDER BY {column} DESC LIMIT ?',
+            (*self.time_range(since, until), limit))
+
+    def best_power(self, duration, since=None, until=None, limit=20):
+        """
+        Best average power of every rider for a duration (seconds) between the dates
+        """
+        return self.query(
+            'SELECT rides.rider, MAX(power_curves.power) AS power, rides.date, '
+            'MAX(power_curves.power) / rides.weight AS power_per_kg FROM power_curves '
+            'JOIN rides ON rides.id = power_curves.ride_id '
+            'WHERE power_curves.duration = ? AND rides.start_time >= ? AND rides.start_time < ? '
+            'GROUP BY rides.rider ORDER BY power DESC LIMIT ?',
+            (int(duration), *self.time_range(since, until), limit))
+
+    def power_curve(self, rider, since=None, until=None):
+        """
+        :return: the best average power of the rider for every duration stored between the dates
+        """
+        return self.query(
+            'SELECT power_curves.duration, MAX(power_curves.power) AS power FROM power_curves '
+            'JOIN rides ON rides.id = power_curves.ride_id '
+            'WHERE rides.rider = ? AND rides.start_time >= ? AND rides.start_time < ? '
+            'GROUP BY power_curves.duration ORDER BY power_curves.duration',
+            (rider, *self.time_range(since, until)))
+
+    @staticmethod
+    def time_range(since, until):
+        # until is a day included in the range
+        until = epoch(until)
+        return epoch(since) or 0, until + 86400 if until is not None else 2 ** 62
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog', default=None, help='SQLite file, default [catalog] path of config.ini')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    leaderboard = subparsers.add_parser('leaderboard', help='best ride of every rider by a column')
+    leaderboard.add_argument('column', choices=sorted(LEADERBOARD_COLUMNS))
+    best_power = subparsers.add_parser('best-power', help='best average power of every rider for a duration')
+    best_power.add_argument('duration', type=int, help='seconds')
+    history = subparsers.add_parser('history', help='rides of a rider')
+    history.add_argument('rider')
+    for subparser in (leaderboard, best_power, history):
+        subparser.add_argument('--since', help='first day, YYYY-MM-DD')
+        subparser.add_argument('--until', help='last day, YYYY-MM-DD')
+    for subparser in (leaderboard, best_power):
+        subparser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    catalog = RideCatalog(args.catalog)
+    if args.command == 'leaderboard':
+        table = catalog.leaderboard(args.column, args.since, args.until, args.limit)
+    elif args.command == 'best-power':
+        table = catalog.best_power(args.duration, args.since, args.until, args.limit)
+    else:
+        table = catalog.rider_history(args.rider, args.since, args.until)
+    print(table.to_string(index=False) if not table.empty else 'No rides')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
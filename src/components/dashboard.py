@@ -9,9 +9,14 @@ def create_dashboard():
         dcc.Graph(id='kilojoules-graph', style={'display': 'none'}),
         dcc.Graph(id='follow_the_leader_plot', style={'display': 'none'}),
         dcc.Graph(id='speed_comparison-graph', style={'display': 'none'}),
+        dcc.Graph(id='power_curve-graph', style={'display': 'none'}),
+        dcc.Graph(id='w_balance-graph', style={'display': 'none'}),
         html.Div(children=[], id='output_table'),
+        html.Div(children=[], id='gap_table'),
+        html.Div(children=[], id='zones_table'),
         html.Div(children=[], id='download_excel_button'),
         html.Button('Download to excel', id='download-table', style={'display': 'none'}),
-        dcc.Download(id='download-table_xlsx')
+        html.Progress(id='download-progress', value='0', max='1', style={'display': 'none'}),
+        html.Div(children=[], id='download-status')
     ], style={'width': 990})
     return component
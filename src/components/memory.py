@@ -1,38 +1,236 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
 from dash import html, dcc
 
+from config import config
+from storage import default_directory, write_frame, read_frame, frame_nbytes, slice_frame, rides_key, json_key, \
+    checked_key, atomic_write
+
+NOT_CONSISTENT = "Rides data not consistent, please clear cache and load again the rides"
+
+
 class MemoryRides:
-    def __init__(self):
-        self.rides = {}
-        self.corrected_rides  = {}
-        self.rides_key = None
-        self.corrected_rides_key = None
+    """
+    Rides of every session, keyed by the rides_key kept in the browser of the session.
+    Each set of rides is written to a local directory shared by all the workers. The most recently used ones
+    are kept in memory within the memory budget, the others are spilled: their column files are memory mapped
+    so they cost no heap and the OS pages them in and out. Sessions not used for ttl seconds are removed.
+    """
+
+    def __init__(self, directory=None, memory_budget=None, ttl=None):
+        if memory_budget is None:
+            memory_budget = config.getint('store', 'memory_budget_mb', fallback=512) * 2 ** 20
+        if ttl is None:
+            ttl = config.getint('store', 'ttl_minutes', fallback=240) * 60
+        self.directory = directory or default_directory('sessions')
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        # (key, kind): (version, rides, nbytes)
+        self.memory = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
 
     def set_rides(self, key, ride_df):
-        self.rides_key = key
-        self.rides[key] = ride_df
+        self.set(key, 'rides', ride_df)
 
-    def set_corrected_rides(self, key, ride_df):
-        self.corrected_rides_key = key
-        self.corrected_rides[key] = ride_df
+    def set_corrected_rides(self, key, starts):
+        """
+        :param starts: {name: (first row, distance offset)} of the start time correction of every ride
+        """
+        self.set_view(key, 'corrected_rides', 'rides', starts)
 
     def get_rides(self, key):
-        if key != self.rides_key:
-            raise KeyError(f"Rides data not consistent, please clear cache and load again the rides")
-
-        return self.rides[key]
+        return self.get(key, 'rides')
 
     def get_corrected_rides(self, key):
-        if key != self.corrected_rides_key:
-            raise KeyError(f"Rides data not consistent, please clear cache and load again the rides")
-
-        return self.corrected_rides[key]
+        return self.get(key, 'corrected_rides')
 
     def clear_history(self):
-        self.rides = {}
-        self.corrected_rides = {}
-        self.rides_key = None
-        self.corrected_rides_key = None
+        with self.lock:
+            self.memory = OrderedDict()
+            self.nbytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def session_path(self, key):
+        return os.path.join(self.directory, checked_key(key, NOT_CONSISTENT))
+
+    def set(self, key, kind, rides):
+        session_path = self.session_path(key)
+        version = uuid.uuid4().hex
+        path = os.path.join(session_path, f'{kind}-{version}')
+        os.makedirs(path)
+
+        for i, ride_df in enumerate(rides.values()):
+            write_frame(ride_df, os.path.join(path, str(i)))
+        with open(os.path.join(path, 'riders.json'), 'w') as f:
+            json.dump(list(rides.keys()), f)
+
+        self.write_pointer(session_path, kind, {'version': version, 'content': rides_key(rides)})
+
+        self.remember(key, kind, version, rides)
+        self.expire()
+
+    def set_view(self, key, kind, base_kind, starts):
+        """
+        Rides that are views of the base_kind rides from a first row on, with the distance counted from there.
+        Only the first rows and offsets are stored, not the frames.
+        """
+        session_path = self.session_path(key)
+        base_version = self.version(key, base_kind)
+        starts = {name: [int(first_row), int(offset)] for name, (first_row, offset) in starts.items()}
+
+        try:
+            pointer = self.pointer(key, kind)
+            if pointer.get('base_version') == base_version and pointer.get('starts') == starts:
+                # Nothing changed, the version and everything derived from it stay valid
+                return
+        except KeyError:
+            pass
+
+        self.write_pointer(session_path, kind, {'version': uuid.uuid4().hex, 'base': base_kind,
+                                                'base_version': base_version, 'starts': starts,
+                                                'content': json_key(self.content_key(key, base_kind), starts)})
+        self.expire()
+
+    def write_pointer(self, session_path, kind, pointer):
+        # Point the session to the new version, other workers pick it up on their next read
+        path = os.path.join(session_path, f'{kind}.json')
+        with atomic_write(path) as f:
+            json.dump(pointer, f)
+
+        current = f'{kind}-{pointer["version"]}'
+        for entry in os.scandir(session_path):
+            if entry.is_dir() and entry.name.startswith(f'{kind}-') and entry.name != current:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def pointer(self, key, kind):
+        session_path = self.session_path(key)
+        try:
+            with open(os.path.join(session_path, f'{kind}.json')) as f:
+                pointer = json.load(f)
+            os.utime(session_path)
+        except (OSError, ValueError):
+            raise KeyError(NOT_CONSISTENT)
+        if 'version' not in pointer:
+            raise KeyError(NOT_CONSISTENT)
+        return pointer
+
+    def version(self, key, kind):
+        """
+        :return: the version of the rides, a new one every time they are set
+        """
+        return self.pointer(key, kind)['version']
+
+    def content_key(self, key, kind):
+        """
+        :return: the hash of the content of the rides, the same for the same rides in any session
+        """
+        pointer = self.pointer(key, kind)
+        return pointer.get('content', pointer['version'])
+
+    def get(self, key, kind):
+        return self.get_with_version(key, kind)[1]
+
+    def get_with_version(self, key, kind, retry=True):
+        session_path = self.session_path(key)
+        pointer = self.pointer(key, kind)
+        version = pointer['version']
+
+        with self.lock:
+            entry = self.memory.get((key, kind))
+            if entry is not None and entry[0] == version:
+                self.memory.move_to_end((key, kind))
+                return version, entry[1]
+
+        if 'base' in pointer:
+            base_version, base = self.get_with_version(key, pointer['base'])
+            if base_version != pointer['base_version']:
+                raise KeyError(NOT_CONSISTENT)
+            rides = {name: slice_frame(base[name], first_row, {'distance': offset})
+                     for name, (first_row, offset) in pointer['starts'].items()}
+            # Only the distance is a new array, the other columns are views of the base rides
+            self.remember(key, kind, version, rides,
+                          nbytes=sum(ride_df['distance'].to_numpy().nbytes for ride_df in rides.values()),
+                          base=pointer['base'])
+            return version, rides
+
+        path = os.path.join(session_path, f'{kind}-{version}')
+        try:
+            rides = self.read(path)
+        except OSError:
+            # Replaced by another worker while reading
+            if retry:
+                return self.get_with_version(key, kind, retry=False)
+            raise KeyError(NOT_CONSISTENT)
+
+        # Read back memory mapped, they only go to the heap through set
+        self.remember(key, kind, version, rides, nbytes=0)
+        return version, rides
+
+    def read(self, path):
+        with open(os.path.join(path, 'riders.json')) as f:
+            names = json.load(f)
+        return {name: read_frame(os.path.join(path, str(i)), mmap=True) for i, name in enumerate(names)}
+
+    def remember(self, key, kind, version, rides, nbytes=None, base=None):
+        """
+        :param nbytes: heap memory of the rides, 0 when they are memory mapped
+        :param base: kind of the rides these rides are views of, they keep its arrays alive
+        """
+        if nbytes is None:
+            nbytes = sum(frame_nbytes(ride_df) for ride_df in rides.values())
+        with self.lock:
+            if (key, kind) in self.memory:
+                self.nbytes -= self.memory.pop((key, kind))[2]
+            self.memory[(key, kind)] = (version, rides, nbytes, base)
+            self.nbytes += nbytes
+
+            # Spill the least recently used rides in the heap to their memory mapped files
+            for (old_key, old_kind), (old_version, _, old_nbytes, old_base) in list(self.memory.items()):
+                if self.nbytes <= self.memory_budget:
+                    break
+                if old_nbytes == 0 or (old_key, old_kind) not in self.memory:
+                    continue
+                path = os.path.join(self.session_path(old_key), f'{old_kind}-{old_version}')
+                try:
+                    mapped = self.read(path)
+                except OSError:
+                    # Replaced or expired in the meantime, or views without files: the next get reads them again
+                    self.memory.pop((old_key, old_kind))
+                else:
+                    self.memory[(old_key, old_kind)] = (old_version, mapped, 0, old_base)
+                self.nbytes -= old_nbytes
+
+                # The views of the spilled rides would keep their heap arrays alive, the next get builds them
+                # again from the memory mapped ones
+                for view_key, view_kind in list(self.memory):
+                    if view_key == old_key and self.memory[(view_key, view_kind)][3] == old_kind:
+                        self.nbytes -= self.memory.pop((view_key, view_kind))[2]
+
+    def expire(self):
+        """
+        Remove the sessions not used within the ttl, from disk and from memory
+        """
+        limit = time.time() - self.ttl
+        expired = set()
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < limit:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    expired.add(entry.name)
+            except FileNotFoundError:
+                pass
 
+        with self.lock:
+            for key, kind in list(self.memory):
+                if key in expired:
+                    self.nbytes -= self.memory.pop((key, kind))[2]
 
 
 def create_memory():
@@ -40,5 +238,10 @@ def create_memory():
         dcc.Store(id='memory-comparative_table', data={}),  # comparative_df
         dcc.Store(id='memory-riders-data', data={}),
         dcc.Store(id='memory-rides-key', data=''),
+        dcc.Store(id='memory-upload-key', data=''),  # files posted to the raw upload route
+        dcc.Store(id='memory-export-key', data=''),  # Excel file written by the export job
+        dcc.Store(id='memory-leader', data=None),  # leader of the follow the leader plot
+        dcc.Store(id='memory-leader-data', data=None),  # distances drawn by the leader clientside callback
         dcc.Store(id='starting-hour', data={'hour': 0, 'minute': 0}),
-    ])
\ No newline at end of file
+        dcc.Store(id='memory-map-markers', data=None),  # markers shown on the map
+    ])
@@ -20,7 +20,9 @@ def create_upload():
             },
             # Allow multiple files to be uploaded
             multiple=True
-        )])
+        ),
+        html.Progress(id='upload-progress', value='0', max='1', style={'display': 'none'}),
+        html.Div(children=[], id='upload-status')])
 
     return component
 
@@ -1,5 +1,7 @@
 from dash import html, dcc
 
+from windows import WINDOWS, AGGREGATES
+
 def create_select_leader():
     component = html.Div([
         html.Div([
@@ -25,9 +27,13 @@ def create_select_start():
     component = html.Div([
         html.H2('Select the start time (hour, minute, second):'),
         #dcc.Slider(0,0, id='time-slider', step=1),
-        dcc.Input(id='start_hour_input', type='number', value='0', min='0', max='23', step='1', ),
-        dcc.Input(id='start_minutes_input', type='number', value='0', min='0', max='59', step='1', ),
-        dcc.Input(id='start_seconds_input', type='number', value='0', min='0', max='59', step='1', ),
+        # The rides are corrected when the typing stops, not on every key
+        dcc.Input(id='start_hour_input', type='number', value='0', min='0', max='23', step='1',
+                  debounce=0.5),
+        dcc.Input(id='start_minutes_input', type='number', value='0', min='0', max='59', step='1',
+                  debounce=0.5),
+        dcc.Input(id='start_seconds_input', type='number', value='0', min='0', max='59', step='1',
+                  debounce=0.5),
         #html.Button('Set starting hour', id='start_button', n_clicks=0)
     ],
         style={
@@ -37,4 +43,32 @@ def create_select_start():
         }
     )
 
-    return component
\ No newline at end of file
+    return component
+
+
+def create_select_window():
+    component = html.Div([
+        html.H2('trailing window:'),
+        dcc.Dropdown(
+            id='window-aggregate-dropdown',
+            options=[{'label': label, 'value': aggregate} for aggregate, (label, unit) in AGGREGATES.items()],
+            value='energy',
+            clearable=False,
+            className="customDropdown"
+        ),
+        dcc.Dropdown(
+            id='window-dropdown',
+            options=[{'label': label, 'value': window} for window, label in WINDOWS.items()],
+            value=3600,
+            clearable=False,
+            className="customDropdown"
+        )
+    ],
+        style={
+            'marginLeft': 15,
+            'marginRight': 15,
+            'marginTop': 30
+        }
+    )
+
+    return component
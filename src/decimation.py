@@ -0,0 +1,143 @@
+import numpy as np
+
+from config import config
+
+
+def bucket_edges(n_points, n_buckets):
+    return np.linspace(0, n_points, n_buckets + 1).astype(np.int64)
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-triangle-three-buckets: keeps the first and last points and, in every bucket in between,
+    the point making the largest triangle with the point kept in the previous bucket and the average
+    of the next bucket.
+    :return: the indices of the points to keep
+    """
+    n_points = len(x)
+    if n_out >= n_points or n_out < 3:
+        return np.arange(n_points)
+
+    edges = bucket_edges(n_points - 2, n_out - 2) + 1
+    starts, ends = edges[:-1], edges[1:]
+
+    # Average point of every bucket, the last point stands for the bucket after the last one
+    counts = ends - starts
+    average_x = np.append(np.add.reduceat(x[1:-1], starts - 1) / counts, x[-1])
+    average_y = np.append(np.add.reduceat(y[1:-1], starts - 1) / counts, y[-1])
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n_points - 1
+    previous = 0
+    for i in range(n_out - 2):
+        ax, ay = x[previous], y[previous]
+        bucket_x = x[starts[i]:ends[i]]
+        bucket_y = y[starts[i]:ends[i]]
+        area = np.abs((ax - average_x[i + 1]) * (bucket_y - ay) - (ax - bucket_x) * (average_y[i + 1] - ay))
+        previous = starts[i] + int(area.argmax())
+        kept[i + 1] = previous
+
+    return kept
+
+
+def minmax(x, y, n_out):
+    """
+    Keeps the lowest and highest point of every bucket, in their original order
+    :return: the indices of the points to keep
+    """
+    n_points = len(x)
+    n_buckets = n_out // 2
+    if n_out >= n_points or n_buckets < 1:
+        return np.arange(n_points)
+
+    # Buckets of the same size, the last points go in a shorter bucket of their own
+    size = int(np.ceil(n_points / n_buckets))
+    padded = np.full(size * n_buckets, np.nan)
+    padded[:n_points] = y
+    buckets = padded.reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+
+    low = offsets + np.nanargmin(buckets, axis=1)
+    high = offsets + np.nanargmax(buckets, axis=1)
+    return np.unique(np.concatenate([[0, n_points - 1], low, high]))
+
+
+METHODS = {'lttb': lttb, 'minmax': minmax}
+
+
+def decimate(x, y, n_out=None, x_range=None, method=None):
+    """
+    Reduce a line to about n_out points keeping its peaks. Only the points within x_range are kept and
+    the gaps (NaN in y) stay gaps, every finite segment gets a share of the points by its length.
+    :return: the decimated x and y arrays
+    """
+    if n_out is None:
+        n_out = config.getint('plots', 'max_points', fallback=2000)
+    if method is None:
+        method = config.get('plots', 'decimation', fallback='lttb')
+    select = METHODS[method]
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    if x_range is not None:
+        # Keep one point on each side so the line reaches the borders of the plot
+        inside = np.flatnonzero((x >= x_range[0]) & (x <= x_range[1]))
+        if len(inside) == 0:
+            return x[:0], y[:0]
+        window = slice(max(inside[0] - 1, 0), min(inside[-1] + 2, len(x)))
+        x, y = x[window], y[window]
+
+    finite = np.isfinite(x) & np.isfinite(y)
+    if len(x) <= n_out:
+        return x, y
+    if finite.all():
+        kept = select(x, y, n_out)
+        return x[kept], y[kept]
+
+    # Split in finite segments and put a NaN between them so the plot keeps the gaps
+    changes = np.flatnonzero(np.diff(np.r_[False, finite, False].astype(np.int8)))
+    segments = changes.reshape(-1, 2)
+    total = max(int(finite.sum()), 1)
+
+    parts_x = []
+    parts_y = []
+    for start, end in segments:
+        share = max(int(n_out * (end - start) / total), 2)
+        kept = start + select(x[start:end], y[start:end], share)
+        parts_x.extend([x[kept], [np.nan]])
+        parts_y.extend([y[kept], [np.nan]])
+
+    if not parts_x:
+        return x[:0], y[:0]
+    return np.concatenate(parts_x[:-1]), np.concatenate(parts_y[:-1])
+
+
+def shared_indices(x, lines, n_out=None, method=None):
+    """
+    Points kept for several lines on the same x so they can still be subtracted from each other: every line
+    gets an equal share of the point budget and the points kept are the union of the ones of every line. The
+    borders of the gaps (NaN) are kept so the gaps stay gaps.
+    :return: the sorted indices of the points to keep
+    """
+    if n_out is None:
+        n_out = config.getint('plots', 'max_points', fallback=2000)
+    if method is None:
+        method = config.get('plots', 'decimation', fallback='lttb')
+    select = METHODS[method]
+
+    x = np.asarray(x, dtype=float)
+    if len(x) <= n_out:
+        return np.arange(len(x))
+
+    share = max(n_out // max(len(lines), 1), 3)
+    kept = [[0, len(x) - 1]]
+    for y in lines:
+        finite = np.isfinite(np.asarray(y, dtype=float))
+        borders = np.flatnonzero(np.diff(finite.astype(np.int8)))
+        kept.extend([borders, borders + 1])
+        indices = np.flatnonzero(finite)
+        if len(indices):
+            kept.append(indices[select(x[indices], np.asarray(y, dtype=float)[indices], share)])
+    return np.unique(np.concatenate(kept).astype(np.int64))
@@ -0,0 +1,118 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from flask import send_file, abort
+
+from storage import default_directory, remove_expired, checked_key, atomic_write
+
+# Columns of the rider sheets and their decimals, the timestamps are written as Excel dates
+EXPORT_COLUMNS = {
+    'timestamp': None,
+    'distance': 0,
+    'altitude': 1,
+    'speed': 1,
+    'power': 0,
+    'heart_rate': 0,
+    'kilojoules_last_hour': 3,
+    'position_lat': 6,
+    'position_long': 6,
+}
+PROGRESS_ROWS = 5000
+EXPORT_ROUTE = '/export'
+
+
+def export_path(export_key):
+    return os.path.join(default_directory('exports'), f'{checked_key(export_key, "Unknown export")}.xlsx')
+
+
+def sheet_title(name, used):
+    """
+    Excel sheet names have at most 31 characters and none of []:*?/\\, and they must be unique
+    """
+    title = re.sub(r'[\[\]:*?/\\]', '_', str(name))[:31] or 'rider'
+    base, i = title, 1
+    while title.lower() in used:
+        suffix = f' ({i})'
+        title = base[:31 - len(suffix)] + suffix
+        i += 1
+    used.add(title.lower())
+    return title
+
+
+def column_values(series, decimals):
+    """
+    :return: the column as a list of Python values, None where there is no value
+    """
+    values = series.to_numpy()
+    if decimals is None:
+        return pd.to_datetime(values, unit='s').to_pydatetime().tolist()
+    if values.dtype.kind != 'f':
+        return values.tolist()
+
+    # float32 columns would show their binary error, e.g. 38.009998
+    values = np.round(values.astype(np.float64), decimals)
+    missing = np.isnan(values)
+    if decimals == 0:
+        return [None if is_missing else int(value) for value, is_missing in zip(values.tolist(), missing)]
+    if missing.any():
+        return [None if is_missing else value for value, is_missing in zip(values.tolist(), missing)]
+    return values.tolist()
+
+
+def write_workbook(path, table, rides, progress=None):
+    """
+    Write the comparative table and one sheet with the time series of every ride. The workbook is in
+    write only mode, openpyxl writes every row to disk when it is appended instead of keeping the cells.
+    :param progress: called with (rows written, total rows)
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Comparative')
+    sheet.append(list(table.columns))
+    for row in table.itertuples(index=False):
+        sheet.append([None if pd.isna(value) else value for value in row])
+
+    total = sum(len(df) for df in rides.values())
+    done = 0
+    used = {'comparative'}
+    for name, df in rides.items():
+        sheet = workbook.create_sheet(sheet_title(name, used))
+        columns = [column for column in EXPORT_COLUMNS if column in df.columns]
+        sheet.append(columns)
+        values = [column_values(df[column], EXPORT_COLUMNS[column]) for column in columns]
+        for i, row in enumerate(zip(*values)):
+            sheet.append(row)
+            if progress is not None and (i + 1) % PROGRESS_ROWS == 0:
+                progress(done + i + 1, total)
+        done += len(df)
+        if progress is not None:
+            progress(done, total)
+
+    with atomic_write(path, 'wb') as f:
+        workbook.save(f)
+
+
+def new_export_path(export_key):
+    # The exports are downloaded right after they are written, the old ones are not needed
+    remove_expired(default_directory('exports'), ttl=3600)
+    os.makedirs(default_directory('exports'), exist_ok=True)
+    return export_path(export_key)
+
+
+def register_export_route(server):
+    """
+    Download of the workbooks written by the export callback, streamed from disk instead of going
+    base64 encoded through a dcc.Download
+    """
+    @server.route(f'{EXPORT_ROUTE}/<export_key>.xlsx')
+    def download_export(export_key):
+        try:
+            path = export_path(export_key)
+        except KeyError:
+            abort(404)
+        if not os.path.exists(path):
+            abort(404)
+        return send_file(path, as_attachment=True, download_name='comparative.xlsx')
@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from alignment import build_ride_matrix
+from config import config
+from instrumentation import span
+from power import matrix_power_curves
+from windows import trailing_windows, window_column
+
+logger = logging.getLogger(__name__)
+
+
+class RideFeatures:
+    """
+    Everything the tables and figures of the Process button derive from the corrected rides, computed once.
+    The builders share it, so they must not modify it: the matrix arrays are read only and the rides are
+    copies of the stored ones.
+    """
+
+    def __init__(self, rides, progress=None):
+        """
+        :param progress: called with (rides done, total rides)
+        """
+        windows = trailing_windows(rides)
+        self.rides = {}
+        for i, (name, df) in enumerate(rides.items()):
+            # New columns only go to the copy, the stored ride is not modified
+            df = df.copy(deep=False)
+            for column, values in windows[name].items():
+                df[column] = values
+            df['kilojoules_last_hour'] = df[window_column('energy', 3600)]
+            self.rides[name] = df
+            if progress is not None:
+                progress(i + 1, len(rides))
+
+        self.matrix = build_ride_matrix(self.rides)
+        for values in self.matrix.columns.values():
+            values.flags.writeable = False
+        self.matrix.mask.flags.writeable = False
+
+        self.power_durations, self.power_curves = matrix_power_curves(self.matrix)
+
+
+class FeatureCache:
+    """
+    RideFeatures of the latest corrected rides, keyed by (rides_key, version of the corrected rides).
+    The version changes with every start time correction, so there is one entry per (rides_key, start time).
+    """
+
+    def __init__(self, max_entries=None):
+        if max_entries is None:
+            max_entries = config.getint('features', 'max_entries', fallback=4)
+        self.max_entries = max_entries
+        self.features = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, rides_key, rides_memory, progress=None):
+        key = (rides_key, rides_memory.version(rides_key, 'corrected_rides'))
+        with self.lock:
+            if key in self.features:
+                self.features.move_to_end(key)
+                return self.features[key]
+
+        start = time.perf_counter()
+        version, rides = rides_memory.get_with_version(rides_key, 'corrected_rides')
+        key = (rides_key, version)
+        with span('features'):
+            features = RideFeatures(rides, progress)
+        logger.info(f'Features of {len(features.rides)} rides computed in {time.perf_counter() - start:.3f} s')
+
+        with self.lock:
+            self.features[key] = features
+            while len(self.features) > self.max_entries:
+                self.features.popitem(last=False)
+
+        return features
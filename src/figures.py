@@ -0,0 +1,210 @@
+import base64
+
+import numpy as np
+from dash import no_update
+import plotly.graph_objects as go
+
+from alignment import distance_gaps
+from decimation import decimate, shared_indices
+from instrumentation import timed
+from windows import WINDOWS, AGGREGATES, window_column
+
+
+def secondary_y_figure():
+    # plotly.subplots is imported when the first figure is built, not when the app boots
+    from plotly.subplots import make_subplots
+    return make_subplots(specs=[[{"secondary_y": True}]])
+
+
+def add_line(fig, x, y, name, x_range=None, **kwargs):
+    """
+    Add a line decimated to the point budget, with only the points in x_range when zoomed in
+    """
+    x, y = decimate(x, y, x_range=x_range)
+    fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=name), **kwargs)
+
+
+def relayout_range(relayout_data):
+    """
+    :return: the x range after a zoom, None when the zoom is reset or no_update when the x axis did not change
+    """
+    if not relayout_data:
+        return no_update
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        return relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    if 'xaxis.range' in relayout_data:
+        return tuple(relayout_data['xaxis.range'])
+    if relayout_data.get('xaxis.autorange'):
+        return None
+    return no_update
+
+
+@timed('leader_figure')
+def build_leader_figure(features, leader, x_range=None):
+    fig = secondary_y_figure()  #go.Figure()
+
+    matrix = features.matrix
+    reference_distance = matrix.row('distance', leader)
+
+    # Distance of every rider with respect to the leader at the same second
+    differences = distance_gaps(matrix, leader)
+
+    #Add activity profile to the graph
+    add_line(fig, reference_distance / 1000, matrix.row('altitude', leader), 'altitude', x_range, secondary_y=True)
+
+    for rider in matrix.riders:
+        if rider != leader:
+            add_line(fig, reference_distance / 1000, differences[matrix.index[rider]], rider, x_range,
+                     secondary_y=False)
+
+    fig.update_layout(
+        title_text=f"<b>Distance with respect to the Leader {leader}</b>",
+        # Keep the zoom when the traces are replaced by the full resolution ones
+        uirevision=leader
+    )
+
+    # Set x-axis title
+    fig.update_xaxes(title_text="Distance (Km)")
+
+    # Set y-axes titles
+    fig.update_yaxes(title_text="Difference (meters)", secondary_y=False)
+    fig.update_yaxes(title_text="Altitude (meters)", secondary_y=True)
+
+    return fig
+
+
+def encode_array(values):
+    """
+    :return: the values as float32 in base64, a Float32Array in the browser
+    """
+    return base64.b64encode(np.ascontiguousarray(values, dtype='<f4').tobytes()).decode()
+
+
+@timed('leader_data')
+def build_leader_data(features):
+    """
+    Distance and altitude of every rider on the matrix grid for the clientside callback that draws the leader
+    figure when the leader changes (leader.js). Every rider keeps the same seconds so the browser can subtract
+    the distances: the decimation points of the distance of every rider with respect to the mean distance
+    and of the altitude, within the point budget. The zoom callback still sends the full resolution.
+    """
+    matrix = features.matrix
+    distance = matrix['distance']
+    recorded = np.isfinite(distance)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # NaN at the seconds nobody rode
+        mean_distance = np.where(recorded, distance, 0).sum(axis=0) / recorded.sum(axis=0)
+    lines = list(distance - mean_distance)
+    lines.append(matrix.row('altitude', matrix.riders[0]))
+    kept = shared_indices(np.arange(matrix.shape[1]), lines)
+    return {
+        'riders': matrix.riders,
+        'distance': {rider: encode_array(matrix.row('distance', rider)[kept]) for rider in matrix.riders},
+        'altitude': {rider: encode_array(matrix.row('altitude', rider)[kept]) for rider in matrix.riders},
+    }
+
+
+@timed('speed_figure')
+def build_speed_figure(features, x_range=None):
+    fig = secondary_y_figure()
+
+    profile_plotted = False
+    for rider, df in features.rides.items():
+        if not profile_plotted:
+            profile_plotted = True
+            add_line(fig, df['distance'] / 1000, df['altitude'], 'Altitude', x_range, secondary_y=True)
+
+        add_line(fig, df['distance'] / 1000, df['speed'], rider, x_range, secondary_y=False)
+
+    # Add figure title
+    fig.update_layout(
+        title_text="<b>Speed</b>",
+        uirevision=True
+    )
+
+    # Set x-axis title
+    fig.update_xaxes(title_text="Distance (Km)")
+
+    # Set y-axes titles
+    fig.update_yaxes(title_text="Speed (Km/h)", secondary_y=False)
+    fig.update_yaxes(title_text="Altitude (meters)", secondary_y=True)
+
+    return fig
+
+
+@timed('kilojoules_figure')
+def build_kilojoules_figure(features, x_range=None, aggregate='energy', window=3600):
+    """
+    Trailing window aggregate of every rider, the energy spent in the last hour by default
+    """
+    fig = secondary_y_figure()  # go.Figure()
+    label, unit = AGGREGATES[aggregate]
+
+    profile_plotted = False
+    for rider, df in features.rides.items():
+        if not profile_plotted:
+            profile_plotted = True
+            add_line(fig, df['distance'] / 1000, df['altitude'], 'Altitude', x_range, secondary_y=True)
+
+        add_line(fig, df['distance'] / 1000, df[window_column(aggregate, window)], rider, x_range, secondary_y=False)
+
+    # Add figure title
+    fig.update_layout(
+        title_text=f"<b> {label} in the last {WINDOWS[window]} </b>",
+        uirevision=True
+    )
+
+    # Set x-axis title
+    fig.update_xaxes(title_text="Distance (Km)")
+
+    # Set y-axes titles
+    fig.update_yaxes(title_text=f"{label} ({unit})", secondary_y=False)
+    fig.update_yaxes(title_text="Altitude (meters)", secondary_y=True)
+
+    return fig
+
+
+@timed('power_curve_figure')
+def build_power_curve_figure(features):
+    fig = go.Figure()
+
+    for rider, curve in features.power_curves.items():
+        fig.add_trace(go.Scatter(x=features.power_durations, y=curve, mode='lines', name=rider))
+
+    # Add figure title
+    fig.update_layout(
+        title_text="<b>Power curve</b>"
+    )
+
+    # Set axes titles
+    fig.update_xaxes(title_text="Duration (seconds)", type='log')
+    fig.update_yaxes(title_text="Best average power (W)")
+
+    return fig
+
+
+@timed('w_balance_figure')
+def build_w_balance_figure(features, w_balance, x_range=None):
+    fig = secondary_y_figure()
+
+    matrix = features.matrix
+    profile_plotted = False
+    for rider, (balance, w_prime) in w_balance.items():
+        distance = matrix.row('distance', rider) / 1000
+        if not profile_plotted:
+            profile_plotted = True
+            add_line(fig, distance, matrix.row('altitude', rider), 'Altitude', x_range, secondary_y=True)
+
+        add_line(fig, distance, balance / 1000, rider, x_range, secondary_y=False)
+
+    fig.update_layout(
+        title_text="<b>W' balance</b>",
+        uirevision=True
+    )
+
+    fig.update_xaxes(title_text="Distance (Km)")
+
+    fig.update_yaxes(title_text="W' balance (kJ)", secondary_y=False)
+    fig.update_yaxes(title_text="Altitude (meters)", secondary_y=True)
+
+    return fig
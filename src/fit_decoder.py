@@ -0,0 +1,341 @@
+"""
+Fast decoder for the FIT messages used by the app.
+
+The message headers are scanned once to find where every record and event message starts, and each
+field is then gathered for all the messages sharing a definition with a single NumPy indexing operation,
+instead of building one dict per message as garmin_fit_sdk does.
+Only the record fields in RECORD_FIELDS are decoded, files that need anything the SDK does on top of that
+(merging hr messages into the records) raise UnsupportedFitFile so the caller can use the SDK instead.
+"""
+import functools
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+FIT_EPOCH_S = 631065600
+
+RECORD_MESG_NUM = 20
+EVENT_MESG_NUM = 21
+HR_MESG_NUM = 132
+TIMESTAMP_FIELD = 253
+
+# field number: (name, scale, offset)
+RECORD_FIELDS = {
+    253: ('timestamp', 1, 0),
+    0: ('position_lat', 1, 0),
+    1: ('position_long', 1, 0),
+    5: ('distance', 100, 0),
+    6: ('speed', 1000, 0),
+    73: ('enhanced_speed', 1000, 0),
+    2: ('altitude', 5, 500),
+    78: ('enhanced_altitude', 5, 500),
+    3: ('heart_rate', 1, 0),
+    4: ('cadence', 1, 0),
+    7: ('power', 1, 0),
+}
+
+# Fields the fast engine renames: its altitude is enhanced_altitude when the file only has that one, and its
+# enhanced_speed is speed
+SDK_ALIASES = {'altitude': 'enhanced_altitude', 'enhanced_speed': 'speed'}
+
+EVENT_FIELDS = {
+    253: ('timestamp', 1, 0),
+    0: ('event', 1, 0),
+    1: ('event_type', 1, 0),
+}
+
+# base type: (numpy type, invalid value)
+BASE_TYPES = {
+    0x00: ('u1', 0xFF),
+    0x01: ('i1', 0x7F),
+    0x02: ('u1', 0xFF),
+    0x83: ('i2', 0x7FFF),
+    0x84: ('u2', 0xFFFF),
+    0x85: ('i4', 0x7FFFFFFF),
+    0x86: ('u4', 0xFFFFFFFF),
+    0x88: ('f4', None),
+    0x89: ('f8', None),
+    0x0A: ('u1', 0x00),
+    0x8B: ('u2', 0x0000),
+    0x8C: ('u4', 0x00000000),
+    0x8E: ('i8', 0x7FFFFFFFFFFFFFFF),
+    0x8F: ('u8', 0xFFFFFFFFFFFFFFFF),
+    0x90: ('u8', 0x0000000000000000),
+}
+
+
+class UnsupportedFitFile(ValueError):
+    pass
+
+
+class Definition:
+    def __init__(self, global_num, byteorder, fields, size):
+        self.global_num = global_num
+        self.byteorder = byteorder
+        # field number: (offset in the message, size, base type)
+        self.fields = fields
+        self.size = size
+        self.timestamp_offset = fields[TIMESTAMP_FIELD][0] if TIMESTAMP_FIELD in fields else None
+        self.positions = []
+        # (message index, timestamp) of the messages with a compressed timestamp header
+        self.compressed_timestamps = []
+
+
+def scan_messages(buffer):
+    """
+    Walk the message headers of the (possibly chained) FIT files in the buffer.
+    :return: the definitions of the messages we decode, with the position of each data message
+    """
+    definitions = []
+    position = 0
+    while position < len(buffer):
+        header_size = buffer[position]
+        if header_size not in (12, 14) or buffer[position + 8:position + 12] != b'.FIT':
+            raise ValueError('The file is not a valid fit file')
+        data_size = int.from_bytes(buffer[position + 4:position + 8], 'little')
+        position = scan_file(buffer, position + header_size, position + header_size + data_size, definitions)
+        # File crc
+        position += 2
+
+    return definitions
+
+
+def scan_file(buffer, position, end, definitions):
+    local_definitions = {}
+    last_timestamp = 0
+
+    while position < end:
+        header = buffer[position]
+        position += 1
+
+        if header & 0x80:
+            # Compressed timestamp header
+            definition = local_definitions[(header >> 5) & 0x03]
+            time_offset = header & 0x1F
+            last_timestamp += (time_offset - last_timestamp) & 0x1F
+            if definition.global_num in (RECORD_MESG_NUM, EVENT_MESG_NUM):
+                definition.compressed_timestamps.append((len(definition.positions), last_timestamp))
+                definition.positions.append(position)
+            position += definition.size
+            continue
+
+        local_num = header & 0x0F
+
+        if header & 0x40:
+            byteorder = 'big' if buffer[position + 1] else 'little'
+            global_num = int.from_bytes(buffer[position + 2:position + 4], byteorder)
+            n_fields = buffer[position + 4]
+            position += 5
+
+            fields = {}
+            size = 0
+            for i in range(n_fields):
+                field_num, field_size, base_type = buffer[position:position + 3]
+                fields[field_num] = (size, field_size, base_type)
+                size += field_size
+                position += 3
+
+            if header & 0x20:
+                n_developer_fields = buffer[position]
+                position += 1
+                for i in range(n_developer_fields):
+                    size += buffer[position + 1]
+                    position += 3
+
+            if global_num == HR_MESG_NUM:
+                raise UnsupportedFitFile('hr messages have to be merged into the records')
+
+            definition = Definition(global_num, byteorder, fields, size)
+            local_definitions[local_num] = definition
+            if global_num in (RECORD_MESG_NUM, EVENT_MESG_NUM):
+                definitions.append(definition)
+            continue
+
+        definition = local_definitions[local_num]
+        if definition.timestamp_offset is not None:
+            offset = position + definition.timestamp_offset
+            last_timestamp = int.from_bytes(buffer[offset:offset + 4], definition.byteorder)
+        if definition.global_num in (RECORD_MESG_NUM, EVENT_MESG_NUM):
+            definition.positions.append(position)
+        position += definition.size
+
+    return position
+
+
+def gather_fields(array, definitions, wanted_fields):
+    """
+    :return: the message positions and {field number: float array with NaN for invalid values},
+    in file order for all the definitions of one message type
+    """
+    positions = []
+    columns = {field_num: [] for field_num in wanted_fields}
+    for definition in definitions:
+        n_messages = len(definition.positions)
+        if n_messages == 0:
+            continue
+
+        starts = np.asarray(definition.positions, dtype=np.int64)
+        messages = array[starts[:, None] + np.arange(definition.size)]
+        positions.append(starts)
+
+        for field_num in wanted_fields:
+            values = np.full(n_messages, np.nan)
+            if field_num in definition.fields:
+                offset, size, base_type = definition.fields[field_num]
+                numpy_type, invalid = BASE_TYPES.get(base_type, (None, None))
+                if numpy_type is not None and np.dtype(numpy_type).itemsize == size:
+                    dtype = np.dtype(numpy_type).newbyteorder('<' if definition.byteorder == 'little' else '>')
+                    raw = messages[:, offset:offset + size].copy().view(dtype).ravel()
+                    valid = ~np.isnan(raw) if invalid is None else raw != invalid
+                    values[valid] = raw[valid]
+
+            if field_num == TIMESTAMP_FIELD and definition.compressed_timestamps:
+                # Messages with a compressed timestamp header carry their time in the header
+                index, timestamps = zip(*definition.compressed_timestamps)
+                values[list(index)] = timestamps
+
+            columns[field_num].append(values)
+
+    if not positions:
+        return np.empty(0, dtype=np.int64), {field_num: np.empty(0) for field_num in wanted_fields}
+
+    positions = np.concatenate(positions)
+    order = np.argsort(positions, kind='stable')
+    return positions[order], {field_num: np.concatenate(values)[order] for field_num, values in columns.items()}
+
+
+def to_datetimes(values):
+    return pd.to_datetime(values + FIT_EPOCH_S, unit='s', utc=True)
+
+
+def to_column(values, scale, offset):
+    if scale == 1 and offset == 0 and not np.isnan(values).any():
+        return values.astype(np.int64)
+    return values / scale - offset
+
+
+@functools.cache
+def event_profile():
+    """
+    garmin_fit_sdk is imported on the first decode, not when the app boots
+    :return: the names of the event and event_type values in the SDK profile
+    """
+    from garmin_fit_sdk import Profile
+    return Profile['types']['event'], Profile['types']['event_type']
+
+
+def read_records(fit_raw_data):
+    """
+    Decode the record and event messages of an uncompressed fit file.
+    :return: the records as {field name: array}, with the same names as garmin_fit_sdk, and the events
+    as a list of dicts like the SDK event_mesgs
+    """
+    buffer = memoryview(fit_raw_data)
+    array = np.frombuffer(fit_raw_data, dtype=np.uint8)
+
+    definitions = scan_messages(buffer)
+
+    record_definitions = [d for d in definitions if d.global_num == RECORD_MESG_NUM]
+    positions, values = gather_fields(array, record_definitions, RECORD_FIELDS)
+
+    records = {}
+    present = set()
+    for definition in record_definitions:
+        present.update(definition.fields)
+        if definition.compressed_timestamps:
+            present.add(TIMESTAMP_FIELD)
+
+    for field_num, (name, scale, offset) in RECORD_FIELDS.items():
+        if field_num not in present or np.isnan(values[field_num]).all():
+            continue
+        if field_num == TIMESTAMP_FIELD:
+            records[name] = to_datetimes(values[field_num])
+        else:
+            records[name] = to_column(values[field_num], scale, offset)
+
+    # The SDK expands speed and altitude into their enhanced fields
+    if 'enhanced_speed' not in records and 'speed' in records:
+        records['enhanced_speed'] = records['speed']
+    if 'altitude' not in records and 'enhanced_altitude' in records:
+        records['altitude'] = records['enhanced_altitude']
+    records.pop('speed', None)
+    records.pop('enhanced_altitude', None)
+
+    event_definitions = [d for d in definitions if d.global_num == EVENT_MESG_NUM]
+    positions, values = gather_fields(array, event_definitions, EVENT_FIELDS)
+    event_names, event_type_names = event_profile()
+
+    events = []
+    for timestamp, event, event_type in zip(values[TIMESTAMP_FIELD], values[0], values[1]):
+        msg = {}
+        if not np.isnan(timestamp):
+            msg['timestamp'] = datetime.fromtimestamp(int(timestamp) + FIT_EPOCH_S, timezone.utc)
+        if not np.isnan(event):
+            msg['event'] = event_names.get(str(int(event)), int(event))
+        if not np.isnan(event_type):
+            msg['event_type'] = event_type_names.get(str(int(event_type)), int(event_type))
+        events.append(msg)
+
+    return records, events
+
+
+def compare_engines(fit_raw_data):
+    """
+    Decode the file with both engines and compare the columns build_df uses.
+    :return: {column: max absolute difference}, NaN where the column is missing in one engine, where only one
+    engine has a value, and for every column when the engines do not give the same number of records
+    """
+    from garmin_fit_sdk import Stream, Decoder
+
+    messages, errors = Decoder(Stream.from_byte_array(fit_raw_data)).read()
+    sdk_df = pd.DataFrame(messages['record_mesgs'])
+    records, events = read_records(fit_raw_data)
+    fast_df = pd.DataFrame(records)
+
+    report = {'records': 0.0 if len(sdk_df) == len(fast_df) else np.nan}
+    for name, scale, offset in RECORD_FIELDS.values():
+        if name in ('speed', 'enhanced_altitude'):
+            continue
+        # The fast engine gives the field the SDK has under the other name of SDK_ALIASES
+        sdk_name = name if name in sdk_df.columns else SDK_ALIASES.get(name, name)
+        if sdk_name not in sdk_df.columns and name not in fast_df.columns:
+            continue
+        if sdk_name not in sdk_df.columns or name not in fast_df.columns or len(sdk_df) != len(fast_df):
+            report[name] = np.nan
+            continue
+        if name == 'timestamp':
+            sdk_values = sdk_df[sdk_name].astype('int64').to_numpy() / 1e9
+            fast_values = fast_df[name].astype('int64').to_numpy() / 1e9
+        else:
+            sdk_values = sdk_df[sdk_name].to_numpy(dtype=float)
+            fast_values = fast_df[name].to_numpy(dtype=float)
+        if np.any(np.isnan(sdk_values) != np.isnan(fast_values)):
+            report[name] = np.nan
+            continue
+        report[name] = float(np.nanmax(np.abs(sdk_values - fast_values), initial=0))
+
+    sdk_starts = [m['timestamp'] for m in messages.get('event_mesgs', []) if m.get('event') == 'timer' and m.get('event_type') == 'start']
+    fast_starts = [m['timestamp'] for m in events if m.get('event') == 'timer' and m.get('event_type') == 'start']
+    report['timer starts'] = 0.0 if sdk_starts == fast_starts else np.nan
+
+    return report
+
+
+if __name__ == '__main__':
+    # python fit_decoder.py ride.fit.gz ... checks the fast engine against garmin_fit_sdk
+    import gzip
+
+    failed = False
+    for filename in sys.argv[1:]:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if filename.endswith('.gz'):
+            data = gzip.decompress(data)
+        report = compare_engines(data)
+        ok = all(v <= 1e-6 for v in report.values())
+        failed = failed or not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {filename} {report}")
+
+    sys.exit(1 if failed else 0)
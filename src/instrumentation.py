@@ -0,0 +1,322 @@
+import atexit
+import cProfile
+import fcntl
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from config import config
+from storage import default_directory, atomic_write
+
+# Upper bounds of the histogram buckets, +Inf is added when exporting
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(2 ** n for n in range(10, 28, 2))
+ARCHIVE_FILE = 'archive.json'
+# Seconds between two writes of the histograms of a process, they are written at its exit and when it answers
+# /metrics too
+FLUSH_SECONDS = 2
+
+HISTOGRAMS = {
+    'cycling_span_seconds': ('Time spent in the instrumented functions', 'span', SECONDS_BUCKETS),
+    'cycling_callback_seconds': ('Time to answer a Dash callback request', 'callback', SECONDS_BUCKETS),
+    'cycling_callback_response_bytes': ('Size of the Dash callback responses', 'callback', BYTES_BUCKETS),
+    'cycling_startup_seconds': ('Boot of the app: time to the app imported and to the first response since the '
+                                'process started, and time of the warm-up', 'phase', SECONDS_BUCKETS),
+}
+
+
+class Metrics:
+    """
+    Histograms of one process. Every process (web workers, background jobs, decoding pool) writes its
+    own to a file of the metrics directory and the /metrics endpoint adds them up, so the endpoint shows
+    the whole app whichever worker answers it.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory('metrics')
+        self.pid = None
+        self.histograms = {}
+        self.dirty = False
+        self.flushed = 0.0
+        self.lock = threading.Lock()
+
+    def reset_after_fork(self):
+        # A forked process starts with the histograms of its parent, they are already counted there
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.histograms = {}
+            self.dirty = False
+            self.flushed = 0.0
+            at_exit(self.flush_pending)
+
+    def observe(self, metric, label, value):
+        """
+        Add the value to the histogram in memory, the histograms are written at most every FLUSH_SECONDS
+        """
+        bounds = HISTOGRAMS[metric][2]
+        with self.lock:
+            self.reset_after_fork()
+            histogram = self.histograms.setdefault(metric, {}).setdefault(
+                label, {'buckets': [0] * len(bounds), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            self.dirty = True
+            if time.monotonic() - self.flushed >= FLUSH_SECONDS:
+                self.flush()
+
+    def flush_pending(self):
+        with self.lock:
+            if self.dirty and self.pid == os.getpid():
+                self.flush()
+
+    def flush(self):
+        # Called with the lock held
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{self.pid}.json')
+        with atomic_write(path) as f:
+            json.dump({'histograms': self.histograms, 'rss': resident_memory()}, f)
+        self.dirty = False
+        self.flushed = time.monotonic()
+
+    def read_all(self):
+        """
+        :return: the histograms of every process added up and the resident memory of the live ones
+        """
+        histograms = {}
+        rss = {}
+        self.flush_pending()
+        if not os.path.isdir(self.directory):
+            return histograms, rss
+
+        self.archive_finished()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            process = read_json(entry.path)
+            if process is None:
+                continue
+            if entry.name != ARCHIVE_FILE:
+                rss[int(entry.name[:-len('.json')])] = process['rss']
+            add_histograms(histograms, process['histograms'])
+
+        return histograms, rss
+
+    def archive_finished(self):
+        """
+        Move the histograms of the finished processes (every background job is one) to a single file
+        """
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json') or entry.name == ARCHIVE_FILE:
+                continue
+            if process_alive(int(entry.name[:-len('.json')])):
+                continue
+            # Only one of the workers gets to rename the file
+            claimed = f'{entry.path}.{uuid.uuid4().hex}.claimed'
+            try:
+                os.rename(entry.path, claimed)
+            except FileNotFoundError:
+                continue
+            process = read_json(claimed)
+            if process is not None:
+                with open(os.path.join(self.directory, 'archive.lock'), 'w') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+                    archive = read_json(archive_path) or {'histograms': {}}
+                    add_histograms(archive['histograms'], process['histograms'])
+                    with atomic_write(archive_path) as f:
+                        json.dump(archive, f)
+            os.remove(claimed)
+
+
+def at_exit(function):
+    """
+    Run function when the process exits. The background jobs are multiprocess children, they end with
+    os._exit after running the finalizers of multiprocess.util instead of the atexit functions.
+    """
+    atexit.register(function)
+    for name in ('multiprocess.util', 'multiprocessing.util'):
+        util = sys.modules.get(name)
+        if util is not None:
+            util.Finalize(None, function, exitpriority=0)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add_histograms(total, histograms):
+    for metric, labels in histograms.items():
+        for label, histogram in labels.items():
+            entry = total.setdefault(metric, {}).setdefault(
+                label, {'buckets': [0] * len(histogram['buckets']), 'sum': 0.0, 'count': 0})
+            entry['buckets'] = [a + b for a, b in zip(entry['buckets'], histogram['buckets'])]
+            entry['sum'] += histogram['sum']
+            entry['count'] += histogram['count']
+
+
+metrics = Metrics()
+
+# Spans of a task running in the decoding pool, sent back to the parent process with its result
+captured_spans = None
+
+
+def resident_memory():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def record_span(name, seconds):
+    if captured_spans is not None:
+        captured_spans.append((name, seconds))
+    else:
+        metrics.observe('cycling_span_seconds', name, seconds)
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """
+    Decorator recording the time of every call of the function in the span histogram
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def call_with_spans(function, *args):
+    """
+    Run function in a pool worker and return its result with the spans it recorded, the parent
+    process records them with record_spans so they are not lost when the pool is shut down
+    """
+    global captured_spans
+    captured_spans = []
+    try:
+        return function(*args), captured_spans
+    finally:
+        captured_spans = None
+
+
+def record_spans(spans):
+    for name, seconds in spans:
+        record_span(name, seconds)
+
+
+def export():
+    """
+    :return: the metrics in the Prometheus text format
+    """
+    histograms, rss = metrics.read_all()
+    lines = []
+    for metric, (description, label_name, bounds) in HISTOGRAMS.items():
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} histogram')
+        for label, histogram in sorted(histograms.get(metric, {}).items()):
+            label = label.replace('\\', '\\\\').replace('"', '\\"')
+            for bound, count in zip(bounds, histogram['buckets']):
+                lines.append(f'{metric}_bucket{{{label_name}="{label}",le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{{label_name}="{label}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{metric}_sum{{{label_name}="{label}"}} {histogram["sum"]}')
+            lines.append(f'{metric}_count{{{label_name}="{label}"}} {histogram["count"]}')
+
+    lines.append('# HELP process_resident_memory_bytes Resident memory of the app processes')
+    lines.append('# TYPE process_resident_memory_bytes gauge')
+    rss[os.getpid()] = resident_memory()
+    for pid, value in sorted(rss.items()):
+        lines.append(f'process_resident_memory_bytes{{pid="{pid}"}} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def callback_name(request):
+    """
+    :return: the first output of the callback, the whole output string of a multi output callback is too long
+    """
+    outputs = (request.get_json(silent=True) or {}).get('outputs')
+    if isinstance(outputs, list) and outputs:
+        outputs = outputs[0]
+    if isinstance(outputs, dict):
+        return f"{outputs.get('id')}.{outputs.get('property')}"
+    return 'unknown'
+
+
+def profiling_requested(request):
+    """
+    [instrumentation] profile: off, cookie (only the requests with the cookie profile=1) or all
+    """
+    mode = config.get('instrumentation', 'profile', fallback='off')
+    return mode == 'all' or (mode == 'cookie' and request.cookies.get('profile') == '1')
+
+
+def register_instrumentation(server):
+    """
+    Time and size of every callback response, optional cProfile dumps of the callback requests, and
+    the /metrics endpoint in the Prometheus text format
+    """
+    from flask import request, g, Response
+
+    @server.before_request
+    def start_request():
+        if not request.path.endswith('_dash-update-component'):
+            return
+        g.request_start = time.perf_counter()
+        if profiling_requested(request):
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    @server.after_request
+    def end_request(response):
+        if 'request_start' not in g:
+            return response
+        name = callback_name(request)
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+            directory = default_directory('profiles')
+            os.makedirs(directory, exist_ok=True)
+            filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.prof"
+            profile.dump_stats(os.path.join(directory, filename))
+        metrics.observe('cycling_callback_seconds', name, time.perf_counter() - g.pop('request_start'))
+        if not response.is_streamed:
+            metrics.observe('cycling_callback_response_bytes', name, response.calculate_content_length() or 0)
+        return response
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return Response(export(), mimetype='text/plain; version=0.0.4')
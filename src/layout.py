@@ -3,7 +3,7 @@ import dash_bootstrap_components as dbc
 from components.title import create_title
 from components.buttons import create_buttons
 from components.upload import create_upload, create_upload_rider_info
-from components.user_input import create_select_leader, create_select_start
+from components.user_input import create_select_leader, create_select_start, create_select_window
 from components.dashboard import create_dashboard
 
 
@@ -17,7 +17,9 @@ def create_layout():
                 create_upload_rider_info(),
                 dcc.Loading(id="loading", type="default", children= create_select_leader()),
                 create_select_start(),
+                create_select_window(),
                 html.Button('Process', id='process-button', n_clicks=0),
+                html.Progress(id='process-progress', value='0', max='1', style={'display': 'none'}),
             ],
             style={'width': 300, 'marginLeft': 35, 'marginTop': 35, 'marginBottom': 35}
         ),
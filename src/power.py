@@ -0,0 +1,174 @@
+import numpy as np
+
+from alignment import build_ride_matrix
+from windows import MAX_SAMPLE_SECONDS
+
+# Durations in seconds of the best power columns of the comparative table
+TABLE_DURATIONS = [30, 60, 300, 600, 720, 1200, 3600]
+
+
+def duration_grid(max_duration, points_per_decade=30, include=TABLE_DURATIONS):
+    """
+    Log-spaced durations from 1 second to max_duration, every second below points_per_decade seconds
+    """
+    if max_duration < 1:
+        return np.empty(0, dtype=np.int64)
+    grid = np.logspace(0, np.log10(max_duration), int(np.log10(max_duration) * points_per_decade) + 1)
+    grid = np.concatenate([grid, [d for d in include if d <= max_duration], [max_duration]])
+    return np.unique(np.round(grid).astype(np.int64))
+
+
+def mean_max_power(power, durations):
+    """
+    Best average power of every rider for every duration, from the cumulative sum of the power.
+    Like a rolling mean, a window with a missing sample is not valid; durations are in samples.
+    :param power: (riders, samples) matrix with NaN where there is no power
+    :return: (riders, durations) matrix, NaN where no window of that duration is valid
+    """
+    power = np.atleast_2d(power)
+    n_riders, n_samples = power.shape
+    missing = np.isnan(power)
+
+    cumulative_power = np.zeros((n_riders, n_samples + 1))
+    np.cumsum(np.where(missing, 0, power), axis=1, out=cumulative_power[:, 1:])
+    cumulative_missing = np.zeros((n_riders, n_samples + 1), dtype=np.int64)
+    np.cumsum(missing, axis=1, out=cumulative_missing[:, 1:])
+
+    curve = np.full((n_riders, len(durations)), np.nan)
+    for j, duration in enumerate(durations):
+        if duration < 1 or duration > n_samples:
+            continue
+        means = (cumulative_power[:, duration:] - cumulative_power[:, :-duration]) / duration
+        valid = cumulative_missing[:, duration:] == cumulative_missing[:, :-duration]
+        best = np.where(valid, means, -np.inf).max(axis=1)
+        curve[:, j] = np.where(np.isfinite(best), best, np.nan)
+
+    return curve
+
+
+def power_curves(rides, durations=None):
+    """
+    Power curves on the shared 1 Hz grid, the seconds without a sample bridged by bridged_power
+    :return: the durations and {rider: best average power for each duration}
+    """
+    return matrix_power_curves(build_ride_matrix(rides, ['power']), durations)
+
+
+def bridged_power(power):
+    """
+    Power on the 1 Hz grid with the seconds without power filled as windows.sample_seconds weights the samples:
+    a sample stands for the seconds since the previous one up to MAX_SAMPLE_SECONDS, the rest of a longer hole
+    is 0 W. So dropped samples and 2 s recordings do not make every window invalid.
+    :param power: (riders, seconds) matrix with NaN where there is no power
+    :return: the filled matrix, NaN before the first and after the last power of a rider and for the riders
+    without power
+    """
+    power = np.atleast_2d(power)
+    n_riders, n_seconds = power.shape
+    if not n_seconds:
+        return power.astype(float)
+    recorded = ~np.isnan(power)
+    seconds = np.arange(n_seconds)
+
+    # Next second with power, n_seconds when there is none
+    following = np.minimum.accumulate(np.where(recorded, seconds, n_seconds)[:, ::-1], axis=1)[:, ::-1]
+    next_power = np.take_along_axis(power, np.minimum(following, n_seconds - 1), axis=1)
+    bridged = np.where(following - seconds < MAX_SAMPLE_SECONDS, next_power, 0.0)
+
+    first = recorded.argmax(axis=1)
+    last = n_seconds - 1 - recorded[:, ::-1].argmax(axis=1)
+    inside = (seconds >= first[:, None]) & (seconds <= last[:, None]) & recorded.any(axis=1)[:, None]
+    return np.where(inside, bridged, np.nan)
+
+
+def matrix_power_curves(matrix, durations=None):
+    power = bridged_power(matrix['power'])
+    if durations is None:
+        durations = duration_grid(int((~np.isnan(power)).sum(axis=1).max(initial=0)))
+    curve = mean_max_power(power, durations)
+    return durations, {name: curve[i] for i, name in enumerate(matrix.riders)}
+
+
+# Skiba W' balance, used for the riders without cp and w_prime in the riders YAML: cp is their ftp
+DEFAULT_W_PRIME = 20000
+# Fractions of W' of the time below columns of the comparative table
+W_BALANCE_THRESHOLDS = [0.5, 0.25]
+
+
+def rider_w_prime(riders, riders_data):
+    """
+    :return: cp (W) and w_prime (J) of every rider as arrays, NaN for the riders without ftp or cp
+    """
+    cp = np.full(len(riders), np.nan)
+    w_prime = np.full(len(riders), np.nan)
+    for i, rider in enumerate(riders):
+        data = (riders_data or {}).get(rider) or {}
+        if data.get('cp', data.get('ftp')) is not None:
+            cp[i] = data.get('cp', data.get('ftp'))
+            w_prime[i] = data.get('w_prime', DEFAULT_W_PRIME)
+    return cp, w_prime
+
+
+def w_prime_balance(power, cp, w_prime, chunk=64):
+    """
+    W' balance of every rider with the differential model of Skiba (2015), on the 1 Hz grid:
+    above cp W' is spent at P - cp, below it recovers at (cp - P) * (W' - balance) / W'. Both cases are
+    balance[t] = a[t] * balance[t - 1] + b[t], a linear recurrence solved for all the riders at once:
+    inside a chunk balance[t] = A[t] * (start + cumsum(b / A)[t]) with A the cumulative product of a, and
+    only the chunk ends are chained in a loop. The chunks keep A far from underflowing.
+    :param power: (riders, samples) matrix with NaN where there is no power, the balance does not change there
+    :param cp: (riders,) critical power in W
+    :param w_prime: (riders,) W' in J
+    :return: (riders, samples) W' balance in J, NaN for the riders without cp
+    """
+    power = np.atleast_2d(power)
+    n_riders, n_samples = power.shape
+    cp = np.asarray(cp, dtype=float)[:, None]
+    w_prime = np.asarray(w_prime, dtype=float)[:, None]
+
+    below = cp - np.nan_to_num(power, nan=cp)
+    recovering = below > 0
+    # Recovering a: 1 - (cp - P) / W', kept positive for nonsense values as a tiny W'
+    a = np.where(recovering, np.clip(1 - below / w_prime, 0.01, 1), 1.0)
+    b = np.where(recovering, w_prime * (1 - a), below)
+
+    n_chunks = -(-n_samples // chunk)
+    padding = ((0, 0), (0, n_chunks * chunk - n_samples))
+    a = np.pad(a, padding, constant_values=1).reshape(n_riders, n_chunks, chunk)
+    b = np.pad(b, padding, constant_values=0).reshape(n_riders, n_chunks, chunk)
+
+    products = np.cumprod(a, axis=2)
+    offsets = products * np.cumsum(b / products, axis=2)
+
+    # balance at the end of every chunk from the balance at its start
+    starts = np.empty((n_riders, n_chunks))
+    balance = w_prime[:, 0]
+    for i in range(n_chunks):
+        starts[:, i] = balance
+        balance = products[:, i, -1] * balance + offsets[:, i, -1]
+
+    balance = products * starts[:, :, None] + offsets
+    return balance.reshape(n_riders, n_chunks * chunk)[:, :n_samples]
+
+
+def matrix_w_prime_balance(matrix, riders_data):
+    """
+    :return: {rider: (W' balance in J on the matrix grid, NaN outside the ride, W' in J)} of the riders with cp
+    """
+    cp, w_prime = rider_w_prime(matrix.riders, riders_data)
+    known = ~np.isnan(cp)
+    if not known.any():
+        return {}
+    # Spent and recovered over the seconds without a sample too, as the power curves
+    balance = w_prime_balance(bridged_power(matrix['power'][known]), cp[known], w_prime[known])
+
+    balances = {}
+    for row, i in enumerate(np.flatnonzero(known)):
+        values = balance[row]
+        recorded = np.flatnonzero(matrix.mask[i])
+        outside = np.ones(len(values), dtype=bool)
+        if len(recorded):
+            outside[recorded[0]:recorded[-1] + 1] = False
+        values[outside] = np.nan
+        balances[matrix.riders[i]] = (values, w_prime[i])
+    return balances
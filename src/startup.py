@@ -0,0 +1,182 @@
+"""
+Boot of the web app: a warm-up of the decoder and the figures with gunicorn --preload, and the time the app
+takes to be imported and to answer its first request, in the cycling_startup_seconds histogram of /metrics.
+
+    python src/startup.py            # import time of every package when the app boots, in a new interpreter
+    python src/startup.py --preload  # as the master of gunicorn --preload, with the warm-up
+"""
+import argparse
+import gc
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from config import config
+from instrumentation import metrics, call_with_spans
+
+logger = logging.getLogger(__name__)
+
+# 3 minute synthetic ride of benchmarks/synthetic.py
+WARMUP_RIDE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warmup.fit.gz')
+
+
+def process_age():
+    """
+    :return: seconds since the process started
+    """
+    try:
+        import psutil
+        return time.time() - psutil.Process().create_time()
+    except ImportError:
+        with open('/proc/self/stat') as f:
+            # starttime, in clock ticks since the boot of the system, is the 22nd field
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+# Start of the process that imports the app, the workers forked by gunicorn --preload keep the one of the master
+boot_time = time.time() - process_age()
+first_response_pid = None
+
+
+def warm_up():
+    """
+    Decode WARMUP_RIDE and build everything the Process button shows from it twice, so the first Upload and
+    Process do not pay for the first use of the decoder, pandas and plotly. The Upload and Process jobs are
+    forked from the web worker and start with what it has already imported and used.
+    """
+    from plotly.io.json import to_json_plotly
+
+    from alignment import time_gaps
+    from aux import decompress_file, build_ride, build_metrics, build_htmlTable, build_gap_table
+    from features import RideFeatures
+    from figures import build_leader_figure, build_speed_figure, build_kilojoules_figure, \
+        build_power_curve_figure, build_w_balance_figure, build_leader_data
+    from power import matrix_w_prime_balance
+    from summary import summarize_rides, build_zones_table
+
+    ride = build_ride(decompress_file(WARMUP_RIDE))
+    rides = {'warm-up 1': ride, 'warm-up 2': ride}
+    riders_data = {name: {'weight': 70, 'ftp': 250} for name in rides}
+    leader = next(iter(rides))
+
+    features = RideFeatures(rides)
+    w_balance = matrix_w_prime_balance(features.matrix, riders_data)
+    summaries = summarize_rides(features.rides, riders_data)
+    table = build_metrics(features.rides, riders_data, (features.power_durations, features.power_curves),
+                          w_balance, summaries)
+    marks, gaps = time_gaps(features.matrix, leader)
+    components = [
+        build_htmlTable(table),
+        build_htmlTable(build_gap_table(marks, gaps, features.matrix.riders)),
+        build_htmlTable(build_zones_table(summaries)),
+        build_leader_figure(features, leader),
+        build_speed_figure(features),
+        build_kilojoules_figure(features),
+        build_power_curve_figure(features),
+        build_w_balance_figure(features, w_balance),
+        build_leader_data(features),
+    ]
+    # As the callback responses are serialized
+    to_json_plotly(components)
+
+
+def preloaded():
+    """
+    :return: whether the app is imported by the master of gunicorn --preload, once for all the workers. Only
+    the command line options are looked at, not preload_app in a gunicorn config file
+    """
+    if not os.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        return False
+    return '--preload' in sys.argv[1:] + os.environ.get('GUNICORN_CMD_ARGS', '').split()
+
+
+def boot(server):
+    """
+    Called once the app is imported: records the import time and the first response of every worker. In the
+    master of gunicorn --preload, also warms up and freezes the objects of the boot. Anywhere else the warm-up
+    would import at every boot what the callbacks import lazily, twice with the reloader of python app.py
+    """
+    seconds = process_age()
+    metrics.observe('cycling_startup_seconds', 'import', seconds)
+    logger.info(f'App imported {seconds:.2f} s after the process started')
+
+    if preloaded():
+        if config.getboolean('startup', 'warmup', fallback=True):
+            start = time.perf_counter()
+            try:
+                # The spans of the warm-up are not requests, they are left out of the histograms
+                call_with_spans(warm_up)
+            except Exception as e:
+                logger.warning(f'Warm-up failed ({type(e).__name__}: {e})')
+            else:
+                seconds = time.perf_counter() - start
+                metrics.observe('cycling_startup_seconds', 'warmup', seconds)
+                logger.info(f'Warm-up in {seconds:.2f} s')
+
+        # The objects of the boot live as long as the app. Frozen, the collector of the workers forked by
+        # the master does not write to them, and their pages stay shared with it
+        gc.freeze()
+
+    @server.after_request
+    def record_first_response(response):
+        global first_response_pid
+        if first_response_pid != os.getpid():
+            first_response_pid = os.getpid()
+            seconds = time.time() - boot_time
+            metrics.observe('cycling_startup_seconds', 'first_response', seconds)
+            logger.info(f'First response {seconds:.2f} s after the app started booting')
+        return response
+
+
+def import_times(module='app', preload=False):
+    """
+    Import a module in a new interpreter with -X importtime. The time of a module includes its own code, the
+    one of app includes the warm-up when imported as by the master of gunicorn --preload.
+    :return: {top level package: seconds spent importing its modules}, the seconds of the whole import and the
+    lines logged by boot
+    """
+    env = dict(os.environ, SERVER_SOFTWARE='gunicorn', GUNICORN_CMD_ARGS='--preload') if preload else None
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, env=env)
+    total = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    packages = {}
+    boot_lines = []
+    for line in result.stderr.splitlines():
+        if ' startup INFO: ' in line:
+            boot_lines.append(line.split(' INFO: ', 1)[1])
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[0].split(':')[1].strip().isdigit():
+            continue
+        package = fields[2].strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(fields[0].split(':')[1]) * 1e-6
+    return packages, total, boot_lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=15, help='packages shown')
+    parser.add_argument('--preload', action='store_true', help='import as gunicorn --preload does, with the warm-up')
+    args = parser.parse_args(argv)
+
+    packages, total, boot_lines = import_times(preload=args.preload)
+    print(f'{"package":<34}{"seconds":>8}')
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'{package:<34}{seconds:>8.3f}')
+    print(f'{"imports":<34}{sum(packages.values()):>8.3f}')
+    print(f'{"interpreter, imports and warm-up" if args.preload else "interpreter and imports":<34}{total:>8.3f}')
+    for line in boot_lines:
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,412 @@
+import base64
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+COLUMNS_FILE = 'columns.json'
+
+
+@functools.cache
+def storage_directory():
+    """
+    Root directory of the files kept by the app, created private to the user of the app. The caches load
+    pickles and object arrays from it, so a directory of the shared temp directory created first by another
+    user is refused instead of used.
+    """
+    directory = config.get('storage', 'directory', fallback='')
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), 'cycling-analytics')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if stat.S_ISLNK(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f'The storage directory {directory} does not belong to the user of the app')
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(directory, 0o700)
+    return directory
+
+
+def default_directory(name):
+    return os.path.join(storage_directory(), name)
+
+
+def remove_expired(directory, ttl):
+    """
+    Remove the files and directories of directory not modified for ttl seconds
+    """
+    if not os.path.isdir(directory):
+        return
+    limit = time.time() - ttl
+    for entry in os.scandir(directory):
+        try:
+            if entry.stat().st_mtime >= limit:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def checked_key(key, message):
+    """
+    Keys that come from the browser go in file paths, they must be one of our uuids
+    :return: the key
+    :raise KeyError: with message for anything else
+    """
+    if not isinstance(key, str) or not re.fullmatch(r'[0-9a-f-]{36}', key):
+        raise KeyError(message)
+    return key
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Open a file next to path that replaces it once written, readers never see a partial file
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_key(data):
+    """
+    Key of a fit.gz file, the hash of its compressed bytes
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def content_key(content):
+    content_type, content_string = content.split(',')
+    return file_key(base64.b64decode(content_string))
+
+
+def path_key(path, chunk_size=2 ** 20):
+    """
+    Same key as file_key for a fit.gz file on disk, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def rides_key(rides):
+    """
+    Hash of the content of the rides: names, columns and values, whatever session they were loaded in
+    """
+    digest = hashlib.sha256()
+    for name, df in rides.items():
+        digest.update(f'{name}\0{len(df)}\0'.encode())
+        for column, series in df.items():
+            values = np.ascontiguousarray(series.to_numpy())
+            digest.update(f'{column}\0{values.dtype.str}\0'.encode())
+            digest.update(values.tobytes() if values.dtype != object else repr(values.tolist()).encode())
+    return digest.hexdigest()
+
+
+def json_key(*parts):
+    """
+    Hash of JSON serializable values, as the riders data, the same whatever the order of the dict keys
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def frame_nbytes(df):
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+def write_frame(df, path):
+    """
+    Write a DataFrame as one .npy file per column plus a json with the column names and dtypes.
+    The directory is written next to the target and renamed, so readers never see a partial frame.
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    os.makedirs(tmp_path)
+
+    columns = []
+    for i, (name, series) in enumerate(df.items()):
+        tz = None
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            tz = str(series.dt.tz)
+            series = series.dt.tz_convert(None)
+        values = series.to_numpy()
+        np.save(os.path.join(tmp_path, f'{i}.npy'), values, allow_pickle=values.dtype == object)
+        columns.append({'name': name, 'tz': tz, 'object': values.dtype == object})
+
+    with open(os.path.join(tmp_path, COLUMNS_FILE), 'w') as f:
+        json.dump(columns, f)
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Someone else already wrote the same frame
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def read_frame(path, mmap=False):
+    """
+    :param mmap: memory map the columns instead of reading them, the DataFrame then holds read only views of
+    the files and the pages are loaded by the OS when used
+    """
+    with open(os.path.join(path, COLUMNS_FILE)) as f:
+        columns = json.load(f)
+
+    data = {}
+    for i, column in enumerate(columns):
+        column_path = os.path.join(path, f'{i}.npy')
+        # Only the columns written as Python objects are unpickled, a frame of an older version without the
+        # flag fails with ValueError on them and is built again by the caller
+        if column.get('object', False):
+            # Columns of Python objects cannot be memory mapped
+            values = np.load(column_path, allow_pickle=True)
+        else:
+            values = np.load(column_path, mmap_mode='r' if mmap else None)
+        series = pd.Series(values, copy=False)
+        if column['tz'] is not None:
+            series = series.dt.tz_localize(column['tz'])
+        data[column['name']] = series
+
+    # Without copy=False pandas would put the columns of the same dtype together in a new array
+    return pd.DataFrame(data, copy=False)
+
+
+def slice_frame(df, first_row, offsets=None):
+    """
+    Rows of df from first_row on, the columns are views of the columns of df
+    :param offsets: {column: value} subtracted from these columns, they are new arrays
+    """
+    data = {}
+    for name, series in df.items():
+        values = series.to_numpy()[first_row:]
+        if offsets and name in offsets:
+            values = values - np.asarray(offsets[name], dtype=values.dtype)
+        data[name] = pd.Series(values, copy=False)
+    return pd.DataFrame(data, copy=False)
+
+
+class DiskCache:
+    """
+    Entries written to disk, where the other workers and the background jobs find them, with the most recently
+    used also kept in memory within the memory budget. The oldest files are removed over the disk budget.
+    Subclasses read and write the files, with path and disk_entries telling where they are.
+    """
+
+    def __init__(self, memory_budget, disk_budget, directory):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        raise NotImplementedError
+
+    def disk_entries(self):
+        """
+        :return: the paths of the entries on disk, without the ones being written
+        """
+        raise NotImplementedError
+
+    def recall(self, key):
+        """
+        :return: the entry kept in memory or None
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def remember(self, key, value, nbytes):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.memory_budget and len(self.entries) > 1:
+                _, (_, old_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+    def prune_disk(self):
+        entries = []
+        for path in self.disk_entries():
+            try:
+                if os.path.isdir(path):
+                    size = sum(f.stat().st_size for f in os.scandir(path))
+                else:
+                    size = os.path.getsize(path)
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:
+                pass
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_budget:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.nbytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class RideCache(DiskCache):
+    """
+    Rides already built from a file, keyed by content_key, each written as a frame directory
+    """
+
+    def __init__(self, memory_budget=None, disk_budget=None, directory=None):
+        if memory_budget is None:
+            memory_budget = config.getint('cache', 'memory_budget_mb', fallback=256) * 2 ** 20
+        if disk_budget is None:
+            disk_budget = config.getint('cache', 'disk_budget_mb', fallback=2048) * 2 ** 20
+        super().__init__(memory_budget, disk_budget, directory or default_directory('ride-cache'))
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def disk_entries(self):
+        return [entry.path for entry in os.scandir(self.directory)
+                if entry.is_dir() and not entry.name.endswith('.tmp')]
+
+    def get(self, key):
+        """
+        :return: a copy of the cached ride, so callers can modify it, or None
+        """
+        ride_df = self.recall(key)
+        if ride_df is not None:
+            self.hits += 1
+            return ride_df.copy()
+
+        try:
+            ride_df = read_frame(self.path(key))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        os.utime(self.path(key))
+        self.hits += 1
+        self.put(key, ride_df)
+        return ride_df.copy()
+
+    def put(self, key, ride_df):
+        self.remember(key, ride_df, frame_nbytes(ride_df))
+        self.write(key, ride_df)
+
+    def write(self, key, ride_df):
+        if os.path.isdir(self.path(key)):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        write_frame(ride_df, self.path(key))
+        self.prune_disk()
+
+
+class ResultCache(DiskCache):
+    """
+    Figures and tables already built, keyed by their name and the hash of everything they are built from,
+    pickled. The results are unpickled on every get, callers can modify them.
+    """
+
+    def __init__(self, memory_budget=None, disk_budget=None, directory=None):
+        if memory_budget is None:
+            memory_budget = config.getint('results', 'memory_budget_mb', fallback=64) * 2 ** 20
+        if disk_budget is None:
+            disk_budget = config.getint('results', 'disk_budget_mb', fallback=512) * 2 ** 20
+        super().__init__(memory_budget, disk_budget, directory or default_directory('results'))
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def disk_entries(self):
+        return [entry.path for entry in os.scandir(self.directory) if entry.name.endswith('.pickle')]
+
+    def get(self, name, key):
+        """
+        :return: the result or None
+        """
+        key = json_key(name, key)
+        data = self.recall(key)
+
+        if data is None:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self.path(key))
+            except OSError:
+                self.count(name, hit=False)
+                return None
+            self.remember(key, data, len(data))
+
+        self.count(name, hit=True)
+        return pickle.loads(data)
+
+    def put(self, name, key, result):
+        key = json_key(name, key)
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        self.remember(key, data, len(data))
+
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(self.path(key), 'wb') as f:
+            f.write(data)
+        self.prune_disk()
+
+    def get_or_build(self, name, key, build):
+        """
+        :param key: JSON serializable values the result depends on
+        :param build: called without arguments on a miss
+        """
+        result = self.get(name, key)
+        if result is None:
+            result = build()
+            self.put(name, key, result)
+        return result
+
+    def count(self, name, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            hits, total = self.hits, self.hits + self.misses
+        logger.info(f'Result cache {"hit" if hit else "miss"} {name}, {hits}/{total} hits '
+                    f'({hits / total:.0%}) in this process')
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+from windows import sample_seconds
+
+# Power zones of Coggan as fractions of the ftp, upper bounds of Z1 to Z6, Z7 is everything above
+POWER_ZONES = [0.55, 0.75, 0.90, 1.05, 1.20, 1.50]
+# Heart rate zones of Coggan as fractions of the lactate threshold heart rate (lthr), Z5 is everything above
+HR_ZONES = [0.69, 0.84, 0.95, 1.06]
+# Zones as fractions of the maximum heart rate, for the riders with max_hr and no lthr
+MAX_HR_ZONES = [0.60, 0.70, 0.80, 0.90]
+# Samples at or below these watts are coasting
+COASTING_WATTS = 30
+NP_WINDOW = 30
+
+
+class RideSummaries:
+    """
+    Summary metrics and time in zones of several rides, one value (or row) per ride in the order of the rides.
+    Every metric is computed for all the rides at once on their samples put one after the other, the sums
+    by ride are bincounts over the ride of each sample.
+    """
+
+    def __init__(self, riders, samples, seconds, average_power, normalized_power, work, above_ftp, coasting,
+                 average_heart_rate, power_zones, heart_rate_zones):
+        self.riders = riders
+        self.samples = samples
+        self.seconds = seconds
+        self.average_power = average_power
+        self.normalized_power = normalized_power
+        self.work = work
+        self.above_ftp = above_ftp
+        self.coasting = coasting
+        self.average_heart_rate = average_heart_rate
+        self.power_zones = power_zones
+        self.heart_rate_zones = heart_rate_zones
+        self.index = {rider: i for i, rider in enumerate(riders)}
+
+
+def rider_thresholds(riders, riders_data):
+    """
+    :return: ftp and heart rate zone reference (lthr, else max_hr) of every rider as arrays, NaN when unknown,
+    and whether the heart rate reference is a maximum heart rate
+    """
+    ftp = np.full(len(riders), np.nan)
+    heart_rate = np.full(len(riders), np.nan)
+    is_max_hr = np.zeros(len(riders), dtype=bool)
+    for i, rider in enumerate(riders):
+        data = (riders_data or {}).get(rider) or {}
+        if data.get('ftp') is not None:
+            ftp[i] = data['ftp']
+        if data.get('lthr') is not None:
+            heart_rate[i] = data['lthr']
+        elif data.get('max_hr') is not None:
+            heart_rate[i] = data['max_hr']
+            is_max_hr[i] = True
+    return ftp, heart_rate, is_max_hr
+
+
+def zone_seconds(values, ride, weights, reference, bounds, n_rides):
+    """
+    Seconds of every ride in each zone, the zone bounds are fractions of the reference of the ride
+    :param weights: seconds each sample stands for
+    :return: (rides, zones) seconds, NaN for the rides without reference
+    """
+    n_zones = len(bounds) + 1
+    known = ~np.isnan(values) & ~np.isnan(reference[ride])
+    zone = np.searchsorted(bounds, values[known] / reference[ride[known]], side='left')
+    seconds = np.bincount(ride[known] * n_zones + zone, weights=weights[known],
+                          minlength=n_rides * n_zones).reshape(n_rides, n_zones)
+    # Integers when no sample is known
+    seconds = seconds.astype(float)
+    seconds[np.isnan(reference)] = np.nan
+    return seconds
+
+
+@timed('ride_summaries')
+def summarize_rides(rides, riders_data=None):
+    """
+    :param rides: {rider: ride DataFrame}
+    :param riders_data: {rider: {'ftp':, 'lthr':, 'max_hr':}}, the zones of the riders without them are NaN
+    """
+    riders = list(rides.keys())
+    n_rides = len(riders)
+    samples = np.array([len(df) for df in rides.values()], dtype=np.int64)
+    ride = np.repeat(np.arange(n_rides), samples)
+    ends = np.cumsum(samples)
+    starts = ends - samples
+    seconds = np.array([int(df['timestamp'].iloc[-1] - df['timestamp'].iloc[0]) if len(df) else 0
+                        for df in rides.values()], dtype=np.int64)
+
+    def column(name):
+        if not n_rides:
+            return np.empty(0)
+        return np.concatenate([df[name].to_numpy(dtype=float) if name in df.columns else np.full(len(df), np.nan)
+                               for df in rides.values()])
+
+    # Work and time in zones count the seconds of every sample, whatever the recording interval
+    weights = np.concatenate([sample_seconds(df['timestamp'].to_numpy(dtype=np.int64)) for df in rides.values()]) \
+        if n_rides else np.empty(0)
+    power = column('power')
+    heart_rate = column('heart_rate')
+    ftp, hr_reference, is_max_hr = rider_thresholds(riders, riders_data)
+    # As in the comparative table, the riders without ftp count the time above 1 W
+    above = np.where(np.isnan(ftp), 1, ftp)
+
+    def ride_sum(values):
+        return np.bincount(ride, weights=values, minlength=n_rides)
+
+    def ride_mean(values):
+        recorded = ~np.isnan(values)
+        return ride_sum(np.where(recorded, values, 0)) / ride_sum(recorded)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        missing = np.isnan(power)
+        clean_power = np.where(missing, 0, power)
+        work = ride_sum(clean_power * weights) * 0.001
+        average_power = ride_mean(power)
+        # NaN compares as False, as in the table with a per row apply
+        above_ftp = ride_sum(power > above[ride]) / samples * 100
+        coasting = ride_sum(power <= COASTING_WATTS) / samples * 100
+        average_heart_rate = ride_mean(heart_rate)
+
+        # Normalized power: 30 samples rolling mean, only the windows inside a ride and without missing samples
+        cumulative_power = np.concatenate([[0], np.cumsum(clean_power)])
+        cumulative_missing = np.concatenate([[0], np.cumsum(missing)])
+        window_end = np.arange(NP_WINDOW, len(power) + 1)
+        window_ride = ride[window_end - 1]
+        valid = ((window_end - NP_WINDOW >= starts[window_ride])
+                 & (cumulative_missing[window_end] == cumulative_missing[window_end - NP_WINDOW]))
+        means = (cumulative_power[window_end] - cumulative_power[window_end - NP_WINDOW]) / NP_WINDOW
+        fourth_powers = np.bincount(window_ride[valid], weights=means[valid] ** 4, minlength=n_rides)
+        normalized_power = (fourth_powers / np.bincount(window_ride[valid], minlength=n_rides)) ** 0.25
+
+        power_zones = zone_seconds(power, ride, weights, ftp, POWER_ZONES, n_rides)
+        heart_rate_zones = np.where(
+            is_max_hr[:, None],
+            zone_seconds(heart_rate, ride, weights, hr_reference, MAX_HR_ZONES, n_rides),
+            zone_seconds(heart_rate, ride, weights, hr_reference, HR_ZONES, n_rides))
+
+    return RideSummaries(riders, samples, seconds, average_power, normalized_power, work, above_ftp, coasting,
+                         average_heart_rate, power_zones, heart_rate_zones)
+
+
+def zone_names():
+    names = [f'Power Z1 <{POWER_ZONES[0]:.0%}']
+    names += [f'Power Z{i + 2} {low:.0%}-{high:.0%}' for i, (low, high) in enumerate(zip(POWER_ZONES, POWER_ZONES[1:]))]
+    names.append(f'Power Z{len(POWER_ZONES) + 1} >{POWER_ZONES[-1]:.0%}')
+    # The bounds of the heart rate zones depend on the reference of the rider
+    names += [f'HR Z{i + 1}' for i in range(len(HR_ZONES) + 1)]
+    return names
+
+
+def build_zones_table(summaries):
+    """
+    Minutes in every power zone (% of ftp) and heart rate zone (HR_ZONES of lthr, or MAX_HR_ZONES of max_hr),
+    empty for the riders without them in the riders data
+    """
+    columns = zone_names()
+    data = []
+    for i, rider in enumerate(summaries.riders):
+        values = np.concatenate([summaries.power_zones[i], summaries.heart_rate_zones[i]]) / 60
+        row = {'name': rider}
+        row.update({name: None if np.isnan(value) else round(float(value), 2) for name, value in zip(columns, values)})
+        data.append(row)
+    return pd.DataFrame(data, columns=['name'] + columns)
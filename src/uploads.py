@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import uuid
+
+from flask import request, jsonify
+
+from config import config
+from storage import default_directory, remove_expired, checked_key
+
+UPLOAD_ROUTE = '/upload/fit'
+NAMES_FILE = 'names.json'
+
+
+def upload_path(upload_key, directory=None):
+    return os.path.join(directory or default_directory('uploads'), checked_key(upload_key, 'Unknown upload'))
+
+
+def save_upload(files, directory=None):
+    """
+    Save the uploaded files one after the other, werkzeug already spools every part of the request to disk
+    :param files: werkzeug FileStorage objects
+    :return: the key of the upload
+    """
+    directory = directory or default_directory('uploads')
+    # Uploads never picked up by the Dash callback, e.g. the browser was closed in between
+    remove_expired(directory, ttl=3600)
+
+    upload_key = str(uuid.uuid4())
+    path = upload_path(upload_key, directory)
+    os.makedirs(path)
+
+    names = []
+    for i, file in enumerate(files):
+        file.save(os.path.join(path, f'{i}.fit.gz'))
+        # The name is only shown to the user, the file is saved under its index
+        names.append(os.path.basename(file.filename or '') or f'{i}.fit.gz')
+
+    with open(os.path.join(path, NAMES_FILE), 'w') as f:
+        json.dump(names, f)
+
+    return upload_key
+
+
+def read_upload(upload_key, directory=None):
+    """
+    :return: the paths of the saved files and their original names
+    """
+    path = upload_path(upload_key, directory)
+    with open(os.path.join(path, NAMES_FILE)) as f:
+        names = json.load(f)
+    return [os.path.join(path, f'{i}.fit.gz') for i in range(len(names))], names
+
+
+def remove_upload(upload_key, directory=None):
+    shutil.rmtree(upload_path(upload_key, directory), ignore_errors=True)
+
+
+def register_upload_route(server):
+    """
+    Raw multipart upload of the fit.gz files, the browser posts them here instead of sending them
+    base64 encoded inside the callback JSON (see assets/raw_upload.js). Only the upload key goes back
+    to the Dash layout, the files are decoded from disk by the update_data_from_files callback.
+    """
+    server.config['MAX_CONTENT_LENGTH'] = config.getint('upload', 'max_mb', fallback=512) * 2 ** 20
+
+    @server.route(UPLOAD_ROUTE, methods=['POST'])
+    def upload_fit():
+        files = request.files.getlist('files')
+        if not files:
+            return jsonify({'error': 'No files in the request'}), 400
+        return jsonify({'upload_key': save_upload(files)})
@@ -0,0 +1,120 @@
+import numpy as np
+
+from instrumentation import timed
+
+# Trailing windows of the window selector, in seconds
+WINDOWS = {300: "5'", 1200: "20'", 3600: '1 h'}
+# Aggregates over a trailing window: label and unit
+AGGREGATES = {
+    'energy': ('Spent energy', 'kJ'),
+    'average_power': ('Average power', 'W'),
+    'heart_rate_drift': ('Heart rate drift', '%'),
+}
+# A sample stands for the seconds since the previous one up to this, longer holes in the recording are gaps
+MAX_SAMPLE_SECONDS = 5
+
+
+def window_column(aggregate, window):
+    return f'{aggregate}_{window}s'
+
+
+def sample_seconds(time):
+    """
+    Seconds each sample stands for: the time since the previous sample, capped at MAX_SAMPLE_SECONDS.
+    The first sample takes the interval of the second one.
+    """
+    seconds = np.diff(time, prepend=time[:1]).astype(float)
+    if len(seconds) > 1:
+        seconds[0] = seconds[1]
+    return np.clip(seconds, 0, MAX_SAMPLE_SECONDS)
+
+
+def cumulative_sums(columns):
+    cumulative = {}
+    for name, values in columns.items():
+        cumulative[name] = np.zeros(len(values) + 1)
+        np.cumsum(values, out=cumulative[name][1:])
+    return cumulative
+
+
+def trailing_sums(time, cumulative, window):
+    """
+    Sum of every column over the trailing window (t - window, t] of every sample, from the cumulative sums of
+    the columns and a binary search of the window starts: O(n) whatever the window
+    :param time: sorted seconds
+    :param cumulative: cumulative sums of the columns as given by cumulative_sums
+    """
+    start = np.searchsorted(time, time - window, side='right')
+    return {name: values[1:] - values[start] for name, values in cumulative.items()}
+
+
+@timed('trailing_windows')
+def trailing_windows(rides, windows=WINDOWS, aggregates=AGGREGATES):
+    """
+    Trailing window aggregates of every sample of every ride, computed for all the rides at once: their
+    times are put one after the other with more than the longest window between two rides, so no
+    window reaches the previous ride.
+    - energy: kJ spent in the window, every sample weighted by the seconds it stands for
+    - average_power: energy over the recorded seconds of the window
+    - heart_rate_drift: decoupling of power and heart rate, how much the power per beat of the second half of
+      the window dropped from the first half, in %; NaN until the window is complete
+    :return: {rider: {window_column(aggregate, window): float32 values}}
+    """
+    riders = list(rides.keys())
+    if not riders:
+        return {}
+    longest = max(windows)
+
+    times, lengths, ride_starts = [], [], []
+    offset = 0
+    for df in rides.values():
+        time = df['timestamp'].to_numpy(dtype=np.int64)
+        ride_starts.append(offset)
+        times.append(time - (time[0] if len(time) else 0) + offset)
+        lengths.append(len(time))
+        offset += (int(time[-1] - time[0]) if len(time) else 0) + 2 * longest
+    time = np.concatenate(times)
+    first_time = np.repeat(ride_starts, lengths)
+
+    seconds = np.concatenate([sample_seconds(t) for t in times])
+
+    def column(name):
+        return np.concatenate([df[name].to_numpy(dtype=float) if name in df.columns else np.full(len(df), np.nan)
+                               for df in rides.values()])
+
+    power = column('power')
+    heart_rate = column('heart_rate')
+    has_power = ~np.isnan(power)
+    # Power per beat only where both are recorded
+    both = has_power & ~np.isnan(heart_rate)
+    cumulative = cumulative_sums({
+        'energy': np.where(has_power, power * seconds, 0) * 0.001,
+        'power_seconds': np.where(has_power, seconds, 0),
+        'paired_power': np.where(both, power * seconds, 0),
+        'paired_heart_rate': np.where(both, heart_rate * seconds, 0),
+    })
+    paired = {name: cumulative[name] for name in ('paired_power', 'paired_heart_rate')}
+
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for window in windows:
+            sums = trailing_sums(time, cumulative, window)
+            if 'energy' in aggregates:
+                results[window_column('energy', window)] = sums['energy'].astype(np.float32)
+            if 'average_power' in aggregates:
+                results[window_column('average_power', window)] = (
+                    sums['energy'] * 1000 / sums['power_seconds']).astype(np.float32)
+            if 'heart_rate_drift' in aggregates:
+                second_half = trailing_sums(time, paired, window / 2)
+                first_power = sums['paired_power'] - second_half['paired_power']
+                first_heart_rate = sums['paired_heart_rate'] - second_half['paired_heart_rate']
+                first = first_power / first_heart_rate
+                second = second_half['paired_power'] / second_half['paired_heart_rate']
+                drift = (first - second) / first * 100
+                drift[time - window < first_time] = np.nan
+                results[window_column('heart_rate_drift', window)] = drift.astype(np.float32)
+
+    # Views of the concatenated results
+    ends = np.cumsum(lengths)
+    return {rider: {name: values[end - length:end] for name, values in results.items()}
+            for rider, end, length in zip(riders, ends, lengths)}